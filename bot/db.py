@@ -0,0 +1,397 @@
+import asyncio
+import os
+import datetime
+import aiosqlite
+from tzlocal import get_localzone_name
+from bot.utils.dates import day_of_year
+from bot import metrics
+
+
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE") or get_localzone_name()
+# Сколько дат может сохранить пользователь, если в users.quota не указано другое
+DEFAULT_QUOTA = int(os.getenv("MAX_DATES", 10))
+# Пользователи раскладываются по минутам часа уведомлений: shard = user_id % SHARDS
+SHARDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    chat_id INTEGER,
+    last_generation TEXT,
+    timezone TEXT,
+    shard INTEGER,
+    quota INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS birthdays (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    name TEXT NOT NULL,
+    day INTEGER,
+    UNIQUE(user_id, date, name)
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated);
+
+CREATE TABLE IF NOT EXISTS throttling (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY(user_id, key)
+);
+"""
+
+# Запросы горячего пути. sqlite3 кеширует подготовленные выражения по тексту запроса,
+# поэтому тексты держатся константами и не собираются на лету.
+ADD_USER = """
+INSERT OR IGNORE INTO users (user_id, chat_id, last_generation, timezone, shard)
+VALUES (?, ?, ?, ?, ?)
+"""
+GET_TIMEZONE = "SELECT timezone FROM users WHERE user_id = ?"
+SET_TIMEZONE = "UPDATE users SET timezone = ? WHERE user_id = ?"
+USER_TIMEZONES = "SELECT DISTINCT timezone FROM users"
+GET_QUOTA = "SELECT quota FROM users WHERE user_id = ?"
+COUNT_BIRTHDAYS = "SELECT COUNT(*) FROM birthdays WHERE user_id = ?"
+ADD_BIRTHDAY = "INSERT INTO birthdays (user_id, date, name, day) VALUES (?, ?, ?, ?)"
+GET_FSM = "SELECT state, data, updated FROM fsm WHERE key = ?"
+SET_FSM = """
+INSERT INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated = excluded.updated
+"""
+DELETE_FSM = "DELETE FROM fsm WHERE key = ?"
+RANGE_BIRTHDAYS = """
+SELECT id, date, name FROM birthdays
+WHERE user_id = ? AND day BETWEEN ? AND ?
+ORDER BY day, id
+"""
+REMOVE_BIRTHDAY = "DELETE FROM birthdays WHERE id = ? AND user_id = ?"
+SHARD_BIRTHDAYS = """
+SELECT users.chat_id, birthdays.name
+FROM users
+JOIN birthdays ON birthdays.user_id = users.user_id
+WHERE users.timezone = ? AND users.shard = ? AND birthdays.day = ?
+"""
+
+connection = None
+_write_lock = asyncio.Lock()
+
+
+async def create_schema(db):
+    """
+    Создает таблицы и индексы базы данных
+
+    Args:
+        db (aiosqlite.Connection) : Соединение с базой данных
+    """
+
+    await db.executescript(SCHEMA)
+    await db.commit()
+
+
+async def connect(path=None):
+    """
+    Открывает общее соединение с базой данных на все время работы бота
+
+    Args:
+        path (str | None) : Путь к базе данных, по умолчанию DB_PATH
+    """
+
+    global connection
+    connection = await aiosqlite.connect(path or DB_PATH, cached_statements=256)
+    await connection.execute("PRAGMA journal_mode=WAL")
+    await connection.execute("PRAGMA synchronous=NORMAL")
+    await create_schema(connection)
+
+
+async def close():
+    """Закрывает общее соединение с базой данных"""
+    global connection
+    if connection is not None:
+        await connection.close()
+        connection = None
+
+
+async def _fetchone(sql, params):
+    with metrics.DB_QUERY_SECONDS.time(metrics.query_name(sql)):
+        async with connection.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+
+async def _fetchall(sql, params):
+    with metrics.DB_QUERY_SECONDS.time(metrics.query_name(sql)):
+        async with connection.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+
+async def _write(sql, params):
+    async with _write_lock:
+        try:
+            with metrics.DB_QUERY_SECONDS.time(metrics.query_name(sql)):
+                async with connection.execute(sql, params) as cursor:
+                    rowcount = cursor.rowcount
+                await connection.commit()
+        except aiosqlite.Error:
+            await connection.rollback()
+            raise
+    return rowcount
+
+
+async def add_user(user_id, chat_id):
+    await _write(ADD_USER, (
+        user_id, chat_id, datetime.datetime(2000, 1, 1).isoformat(),
+        DEFAULT_TIMEZONE, user_id % SHARDS
+    ))
+
+
+async def get_timezone(user_id):
+    row = await _fetchone(GET_TIMEZONE, (user_id,))
+    return row[0] if row else DEFAULT_TIMEZONE
+
+
+async def set_timezone(user_id, timezone):
+    await _write(SET_TIMEZONE, (timezone, user_id))
+
+
+async def user_timezones():
+    """
+    Returns:
+        list : Часовые пояса, в которых есть пользователи
+    """
+
+    return [timezone for timezone, in await _fetchall(USER_TIMEZONES, ())]
+
+
+async def get_quota(user_id):
+    row = await _fetchone(GET_QUOTA, (user_id,))
+    return row[0] if row and row[0] is not None else DEFAULT_QUOTA
+
+
+async def count_birthdays(user_id):
+    count, = await _fetchone(COUNT_BIRTHDAYS, (user_id,))
+    return count
+
+
+async def add_birthday(user_id, date, name):
+    """
+    Добавляет дату пользователю
+
+    Returns:
+        bool : False, если такая запись уже есть
+    """
+
+    try:
+        await _write(ADD_BIRTHDAY, (user_id, date, name, day_of_year(date)))
+    except aiosqlite.IntegrityError:
+        return False
+    return True
+
+
+async def import_birthdays(user_id, entries):
+    """
+    Добавляет пользователю даты одной транзакцией в пределах его квоты
+
+    Args:
+        user_id (int) : ID пользователя
+        entries (list) : Пары (дата "дд.мм", имя) без повторов
+
+    Returns:
+        dict : Количество добавленных записей (added), уже существовавших (existing)
+            и не поместившихся в квоту (over_quota)
+    """
+
+    quota = await get_quota(user_id)
+    async with _write_lock:
+        existing = set(await _fetchall(
+            "SELECT date, name FROM birthdays WHERE user_id = ?", (user_id,)
+        ))
+        new_entries = [entry for entry in entries if entry not in existing]
+        accepted = new_entries[:max(0, quota - len(existing))]
+        if accepted:
+            with metrics.DB_QUERY_SECONDS.time("import birthdays"):
+                await connection.executemany(
+                    ADD_BIRTHDAY,
+                    [(user_id, date, name, day_of_year(date)) for date, name in accepted]
+                )
+                await connection.commit()
+    return {
+        "added": len(accepted),
+        "existing": len(entries) - len(new_entries),
+        "over_quota": len(new_entries) - len(accepted),
+    }
+
+
+async def _range_birthdays(user_id, first_day, last_day):
+    return await _fetchall(RANGE_BIRTHDAYS, (user_id, first_day, last_day))
+
+
+async def list_birthdays(user_id, today):
+    """
+    Возвращает даты пользователя в порядке приближения, начиная с сегодняшней.
+    Делается двумя проходами по индексу (user_id, day): от сегодня до конца года и с начала года.
+
+    Args:
+        user_id (int) : ID пользователя
+        today (int) : Номер сегодняшнего дня года
+
+    Returns:
+        list : Тройки (id, дата, имя)
+    """
+
+    return (
+        await _range_birthdays(user_id, today, 366)
+        + await _range_birthdays(user_id, 1, today - 1)
+    )
+
+
+async def upcoming_birthdays(user_id, first_day, last_day):
+    """
+    Возвращает даты пользователя с first_day по last_day включительно,
+    диапазон может переходить через конец года
+
+    Returns:
+        list : Тройки (id, дата, имя) в порядке приближения
+    """
+
+    if first_day <= last_day:
+        return await _range_birthdays(user_id, first_day, last_day)
+    return (
+        await _range_birthdays(user_id, first_day, 366)
+        + await _range_birthdays(user_id, 1, last_day)
+    )
+
+
+async def remove_birthdays(user_id, nums, ids):
+    """
+    Удаляет даты по их порядковым номерам в показанном пользователю списке одной транзакцией
+
+    Args:
+        user_id (int) : ID пользователя
+        nums (list) : Порядковые номера
+        ids (list) : ID записей в том порядке, в котором список был показан пользователю
+
+    Returns:
+        (list, list) : Удаленные номера и номера, для которых записей нет
+    """
+
+    removed, missing = [], []
+    async with _write_lock:
+        with metrics.DB_QUERY_SECONDS.time("remove birthdays"):
+            for num in nums:
+                deleted = 0
+                if 1 <= num <= len(ids):
+                    async with connection.execute(REMOVE_BIRTHDAY, (ids[num - 1], user_id)) as cursor:
+                        deleted = cursor.rowcount
+                (removed if deleted else missing).append(num)
+            if removed:
+                await connection.commit()
+    return removed, missing
+
+
+async def shard_birthdays(timezone, shard, day):
+    """
+    Returns:
+        list : Пары (chat_id, имя) для Дней Рождения в день года day
+            у пользователей из часового пояса timezone и шарда shard
+    """
+
+    return await _fetchall(SHARD_BIRTHDAYS, (timezone, shard, day))
+
+
+async def add_outbox(messages):
+    """
+    Записывает исходящие сообщения в outbox одной транзакцией
+
+    Args:
+        messages (list) : Пары (chat_id, текст)
+
+    Returns:
+        list : Тройки (id, chat_id, текст)
+    """
+
+    rows = []
+    async with _write_lock:
+        with metrics.DB_QUERY_SECONDS.time("insert outbox"):
+            for chat_id, text in messages:
+                async with connection.execute(
+                    "INSERT INTO outbox (chat_id, text) VALUES (?, ?)", (chat_id, text)
+                ) as cursor:
+                    rows.append((cursor.lastrowid, chat_id, text))
+            await connection.commit()
+    return rows
+
+
+async def pending_outbox():
+    """
+    Returns:
+        list : Неотправленные сообщения (id, chat_id, текст) в порядке добавления
+    """
+
+    return await _fetchall("SELECT id, chat_id, text FROM outbox ORDER BY id", ())
+
+
+async def remove_outbox(outbox_id):
+    await _write("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+
+
+async def get_fsm(key):
+    """
+    Returns:
+        tuple | None : Состояние, данные в json и время изменения
+    """
+
+    return await _fetchone(GET_FSM, (key,))
+
+
+async def set_fsm(key, state, data, updated):
+    await _write(SET_FSM, (key, state, data, updated))
+
+
+async def delete_fsm(key):
+    await _write(DELETE_FSM, (key,))
+
+
+async def delete_expired_fsm(before):
+    """Удаляет состояния FSM, не менявшиеся с момента before"""
+    return await _write("DELETE FROM fsm WHERE updated < ?", (before,))
+
+
+async def load_throttling():
+    """
+    Returns:
+        list : Сохраненные ведра ограничения частоты (user_id, key, tokens, updated)
+    """
+
+    return await _fetchall("SELECT user_id, key, tokens, updated FROM throttling", ())
+
+
+async def save_throttling(rows):
+    """
+    Сохраняет ведра ограничения частоты одной транзакцией
+
+    Args:
+        rows (list) : Кортежи (user_id, key, tokens, updated)
+    """
+
+    async with _write_lock:
+        with metrics.DB_QUERY_SECONDS.time("insert throttling"):
+            await connection.executemany(
+                "INSERT OR REPLACE INTO throttling (user_id, key, tokens, updated) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            await connection.commit()
@@ -4,12 +4,15 @@ from aiogram.types import Message
 from aiogram.filters import or_f
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from datetime import datetime
-import aiosqlite
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import html
+from bot import db
+from bot.utils.dates import day_of_year, days_until, is_valid_dd_mm
 
 
 router = Router()
-MAX_DATES = 10
+MAX_REMOVE_NUMS = 1000
 
 
 class AddForm(StatesGroup):
@@ -20,46 +23,46 @@ class RemoveForm(StatesGroup):
     num_input = State()
 
 
-def is_valid_dd_mm(date_str):
-    if len(date_str) != 5:
-        return False
-    try:
-        datetime.strptime(date_str, "%d.%m")
-        return True
-    except ValueError:
-        return False
-    
+async def user_today(user_id):
+    """Сегодняшняя дата в часовом поясе пользователя"""
+    timezone = await db.get_timezone(user_id)
+    return datetime.now(ZoneInfo(timezone)).date()
 
-async def reset_autoincrement(user_id, db):
-    await db.execute(f"""
-        CREATE TABLE temp_table AS
-        SELECT * FROM user_{user_id} ORDER BY id
-    """)
-    await db.execute(f"DROP TABLE user_{user_id}")
-    await db.execute(f"""
-        CREATE TABLE user_{user_id} (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            name TEXT,
-            UNIQUE(date, name)
-        )
-    """)
-    await db.execute(f"""
-        INSERT INTO user_{user_id} (date, name)
-        SELECT date, name FROM temp_table
-    """)
-    await db.execute("DROP TABLE temp_table")
 
+def parse_nums(text):
+    """
+    Разбирает список порядковых номеров вида "1,3,5-7"
+
+    Args:
+        text (str) : Номера через запятую, можно указывать диапазоны через дефис
+
+    Returns:
+        list | None : Отсортированные номера без повторов или None, если формат неверный
+    """
+
+    nums = set()
+    for part in text.replace(' ', '').split(','):
+        first, dash, last = part.partition('-')
+        if not first.isdigit() or (dash and not last.isdigit()):
+            return None
+        first, last = int(first), int(last or first)
+        if first < 1 or last < first or len(nums) + last - first >= MAX_REMOVE_NUMS:
+            return None
+        nums.update(range(first, last + 1))
+    return sorted(nums)
+
+
+def today_day(today):
+    return day_of_year(today.strftime("%d.%m"))
+    
 
 @router.message(StateFilter(None), or_f(
     Command("add_date"),
     F.text.lower() == 'добавить дату'
-))
+), flags={"throttling": "dates"})
 async def add_date(message: Message, state: FSMContext):
-    async with aiosqlite.connect("bot.db") as db:
-        cursor = await db.execute(f"SELECT * FROM user_{message.from_user.id}")
-        data = await cursor.fetchall()
-    if len(data) < MAX_DATES:
+    count = await db.count_birthdays(message.from_user.id)
+    if count < await db.get_quota(message.from_user.id):
         await message.answer(
             "Введите дату в формате дд.мм" 
         )
@@ -99,18 +102,15 @@ async def input_incorrect_date(message: Message, state: FSMContext):
 async def input_correct_name(message: Message, state: FSMContext):
     await state.update_data(birthday_name=message.text)
     user_data = await state.get_data()
-    async with aiosqlite.connect("bot.db") as db:
-        try:
-            await db.execute(
-                f"INSERT INTO user_{message.from_user.id} (date, name) VALUES (?, ?)",
-                (user_data['birthday_date'], user_data['birthday_name'])
-            )
-            await message.answer(
-                f"Добавил {user_data['birthday_date']}, {user_data['birthday_name']}" 
-            )
-        except aiosqlite.IntegrityError:
-            await message.answer('Такая запись уже есть')
-        await db.commit()
+    added = await db.add_birthday(
+        message.from_user.id, user_data['birthday_date'], user_data['birthday_name']
+    )
+    if added:
+        await message.answer(
+            f"Добавил {user_data['birthday_date']}, {user_data['birthday_name']}" 
+        )
+    else:
+        await message.answer('Такая запись уже есть')
     await state.clear()
 
 
@@ -127,38 +127,45 @@ async def input_incorrect_name(message: Message, state: FSMContext):
 @router.message(StateFilter(None), or_f(
     Command("remove_date"),
     F.text.lower() == 'удалить дату'
-))
+), flags={"throttling": "dates"})
 async def remove_date(message: Message, state: FSMContext):
-    async with aiosqlite.connect("bot.db") as db:
-        cursor = await db.execute(f"SELECT * FROM user_{message.from_user.id}")
-        data = await cursor.fetchall()
-    if len(data) < 1:
+    count = await db.count_birthdays(message.from_user.id)
+    if count < 1:
         await message.answer(
             "У вас нет добавленных дат" 
         )
     else:
-        await show_dates(message)
+        data = await show_dates(message)
         await message.answer(
-            "Отправьте порядковый номер (ID) даты для её удаления" 
+            "Отправьте порядковый номер (ID) даты для её удаления.\n"
+            "Можно удалить несколько дат сразу: 1,3,5-7"
         )
+        # Номера относятся к показанному списку, даже если порядок потом изменится
+        await state.update_data(remove_ids=[row[0] for row in data])
         await state.set_state(RemoveForm.num_input)
 
 
 @router.message(
     RemoveForm.num_input,
-    F.text.func(lambda text: text.isdigit() and int(text) > 0)
+    F.text.func(parse_nums)
 )
 async def input_remove_num(message: Message, state: FSMContext):
-    id = int(message.text)
-    async with aiosqlite.connect("bot.db") as db:
-        cursor = await db.execute(f"SELECT 1 FROM user_{message.from_user.id} WHERE id = ?", (id,))
-        if not await cursor.fetchone():
-            await message.answer(f"Запись с ID {id} не найдена")
+    nums = parse_nums(message.text)
+    ids = (await state.get_data()).get('remove_ids', [])
+    removed, missing = await db.remove_birthdays(message.from_user.id, nums, ids)
+
+    if len(nums) == 1:
+        if removed:
+            await message.answer(f"Удалил дату с ID {nums[0]}")
         else:
-            await db.execute(f"DELETE FROM user_{message.from_user.id} WHERE id = ?", (id,))
-            await message.answer(f"Удалил дату с ID {id}")
-            await reset_autoincrement(message.from_user.id, db)
-        await db.commit()
+            await message.answer(f"Запись с ID {nums[0]} не найдена")
+    else:
+        answer = []
+        if removed:
+            answer.append("Удалил даты с ID " + ", ".join(map(str, removed)))
+        if missing:
+            answer.append("Не найдены записи с ID " + ", ".join(map(str, missing)))
+        await message.answer("\n".join(answer))
     await state.clear()
 
 
@@ -167,21 +174,60 @@ async def input_remove_num(message: Message, state: FSMContext):
     F.text
 )
 async def input_remove_num_incorrect(message: Message, state: FSMContext):
-    await message.answer("ID должен быть целым положительным числом")
+    await message.answer(
+        "ID должен быть целым положительным числом.\n"
+        "Несколько ID перечисляются через запятую, диапазоны - через дефис: 1,3,5-7"
+    )
+
+
+def format_dates(data):
+    """
+    Args:
+        data (list) : Тройки (id, дата, имя)
+
+    Returns:
+        str : Нумерованный список дат в разметке HTML. Имена экранируются,
+            потому что при импорте из файла в них могут быть <, > и &
+    """
+
+    return ''.join(
+        f'<b>{i}</b>. {html.escape(name)}, {html.escape(date)}\n'
+        for i, (_, date, name) in enumerate(data, start=1)
+    )
+
+
+def format_upcoming(data, today):
+    """
+    Args:
+        data (list) : Тройки (id, дата, имя)
+        today (datetime.date) : Сегодняшняя дата пользователя
+
+    Returns:
+        str : Список ближайших дат в разметке HTML
+    """
+
+    lines = []
+    for _, date, name in data:
+        days = days_until(date, today)
+        when = {0: 'сегодня', 1: 'завтра'}.get(days, f'через {days} дн.')
+        lines.append(f'<b>{html.escape(name)}</b>, {html.escape(date)} - {when}\n')
+    return ''.join(lines)
 
 
 @router.message(or_f(
     Command("show_dates"),
     F.text.lower() == 'показать мои даты'
-))
+), flags={"throttling": "dates"})
 async def show_dates(message: Message):
-    async with aiosqlite.connect("bot.db") as db:
-        cursor = await db.execute(f"SELECT * FROM user_{message.from_user.id}")
-        data = await cursor.fetchall()
-    data_txt = ''
-    for item in data:
-        data_txt += f'<b>{item[0]}</b>. ' + ', '.join(item[1:][::-1]) + '\n'
-    
+    """
+    Returns:
+        list : Показанные даты, тройки (id, дата, имя)
+    """
+
+    today = await user_today(message.from_user.id)
+    data = await db.list_birthdays(message.from_user.id, today_day(today))
+    data_txt = format_dates(data)
+
     if data_txt != '':
         await message.answer(
             f"Ваши даты:\n{data_txt}",
@@ -192,3 +238,24 @@ async def show_dates(message: Message):
             f"У вас нет добавленных дат",
             parse_mode='HTML'  
         )
+    return data
+
+
+@router.message(or_f(
+    Command("upcoming"),
+    F.text.lower() == 'ближайшие даты'
+), flags={"throttling": "dates"})
+async def upcoming_dates(message: Message):
+    today = await user_today(message.from_user.id)
+    data = await db.upcoming_birthdays(
+        message.from_user.id, today_day(today), today_day(today + timedelta(days=6))
+    )
+    data_txt = format_upcoming(data, today)
+
+    if data_txt != '':
+        await message.answer(
+            f"Дни Рождения на этой неделе:\n{data_txt}",
+            parse_mode='HTML'
+        )
+    else:
+        await message.answer("На этой неделе Дней Рождения нет")
@@ -1,49 +1,275 @@
 from aiogram import Router, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramAPIError
 from aiogram.types import Message
-from model import inference
 from aiogram.filters import or_f
-import aiosqlite
-from datetime import datetime
+from bot.services.generation import generation_service, QueueFullError
+from bot.services.wish_pool import WishPool
+from bot.utils.prompts import load_styles, parse_options, build_prompt
+from bot import metrics
+import asyncio
+import logging
+import os
+import random
+import time
 
 
 router = Router()
+logger = logging.getLogger(__name__)
 model_path = "./tinyllama/merged"
-model, tokenizer = inference.prepare_merged_model_and_tokenizer(model_path)
-prompt = "### Instruction: Напиши подравление c Днем Рождения"
-model.eval() 
+batch_size = int(os.getenv("GENERATION_BATCH_SIZE", 8))
+stream_edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+styles = load_styles()
 
+# Модель загружается в фоне после старта бота, см. start_loading
+inference = None
+model, tokenizer = None, None
+prefix_cache = None
+model_ready = asyncio.Event()
+# Загрузка завершилась, успешно или нет: если модель не загрузилась, model_ready не будет установлен
+model_loaded = asyncio.Event()
+_loading_task = None
 
-def generate():
-    response = inference.generate_response(model, tokenizer, prompt)
-    response = response.split('### Response: ')[-1]
+
+def load_model():
+    """
+    Загружает модель и логирует, сколько времени заняли
+    импорт библиотек, токенайзер, веса и первый токен
+    """
+
+    global inference, model, tokenizer, prefix_cache
+    start = time.perf_counter()
+    from model import inference as inference_module
+    timings = {'import': time.perf_counter() - start}
+
+    loaded_model, loaded_tokenizer = inference_module.prepare_merged_model_and_tokenizer(
+        model_path,
+        backend=os.getenv("INFERENCE_BACKEND", "auto"),
+        num_threads=int(os.getenv("INFERENCE_THREADS", 0)),
+        quantized_path="./tinyllama/quantized",
+        timings=timings
+    )
+    loaded_model.eval()
+
+    loaded_cache = inference_module.PrefixCache(int(os.getenv("PREFIX_CACHE_SIZE", 32)))
+    prefix, suffix, _ = build_prompt(styles[0])
+    start = time.perf_counter()
+    inference_module.generate_response(
+        loaded_model, loaded_tokenizer, suffix, max_new_tokens=1, prefix=prefix, prefix_cache=loaded_cache
+    )
+    timings['first_token'] = time.perf_counter() - start
+
+    inference, model, tokenizer = inference_module, loaded_model, loaded_tokenizer
+    prefix_cache = loaded_cache
+    logger.info(
+        "Model loaded in %.1f s: %s",
+        sum(timings.values()),
+        ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in timings.items())
+    )
+
+
+async def _load_model():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, load_model)
+    except Exception:
+        logger.exception("Failed to load model from %s", model_path)
+    else:
+        model_ready.set()
+    finally:
+        model_loaded.set()
+
+
+async def wait_model():
+    """
+    Ожидает окончания загрузки модели
+
+    Returns:
+        bool : Загрузилась ли модель
+    """
+
+    await model_loaded.wait()
+    return model_ready.is_set()
+
+
+async def start_loading():
+    """Запускает фоновую загрузку модели, не задерживая старт бота"""
+    global _loading_task
+    _loading_task = asyncio.create_task(_load_model())
+
+
+def make_prompt(options=None):
+    """
+    Returns:
+        (str, str, dict) : Префикс в случайном стиле, персональный суффикс
+            и ограничения ответа, см. build_prompt
+    """
+
+    return build_prompt(random.choice(styles), **(options or {}))
+
+
+def generate(options=None):
+    """
+    Генерирует поздравление
+
+    Args:
+        options (dict | None) : name, relationship, tone, length, см. parse_options
+
+    Returns:
+        str : Поздравление
+    """
+
+    prefix, suffix, limits = make_prompt(options)
+    stats = {} if metrics.ENABLED else None
+    response = inference.generate_response(
+        model, tokenizer, suffix, stats=stats, prefix=prefix, prefix_cache=prefix_cache, **limits
+    )
+    metrics.record_generation("single", stats)
     return response
 
 
+def generate_streaming(on_text, options=None):
+    """
+    Генерирует поздравление, передавая накопленный текст в on_text по мере генерации
+
+    Args:
+        on_text (callable) : Функция, принимающая текущий текст поздравления
+        options (dict | None) : name, relationship, tone, length, см. parse_options
+
+    Returns:
+        str : Поздравление
+    """
+
+    prefix, suffix, limits = make_prompt(options)
+    stats = {} if metrics.ENABLED else None
+    response = ''
+    for text in inference.generate_stream(
+        model, tokenizer, suffix, stats=stats, prefix=prefix, prefix_cache=prefix_cache, **limits
+    ):
+        response += text
+        on_text(response)
+    metrics.record_generation("stream", stats)
+    return response
+
+
+def generate_batch(n, names=None):
+    """
+    Генерирует несколько поздравлений за один батч.
+    Промпты в батче разной длины, поэтому кеш префиксов здесь не используется.
+
+    Args:
+        n (int) : Количество поздравлений
+        names (list | None) : Имена именинников для персональных поздравлений
+
+    Returns:
+        list : Поздравления
+    """
+
+    prompts = []
+    for i in range(n):
+        prefix, suffix, limits = make_prompt({"name": names[i]} if names else None)
+        prompts.append(prefix + suffix)
+    stats = {} if metrics.ENABLED else None
+    responses = inference.generate_batch(model, tokenizer, prompts, batch_size=n, stats=stats, **limits)
+    metrics.record_generation("batch", stats)
+    return responses
+
+
+wish_pool = WishPool(
+    generate_batch,
+    path=os.getenv("WISH_POOL_PATH", "wish_pool.json"),
+    size=int(os.getenv("WISH_POOL_SIZE", 20)),
+    batch_size=batch_size,
+    ready=model_ready
+)
+
+
+async def _edit(reply: Message, text):
+    """
+    Редактирует сообщение. Ошибки Telegram (лимит редактирований в чате, сообщение
+    удалено или не изменилось) не прерывают генерацию
+
+    Returns:
+        bool : Удалось ли отредактировать сообщение
+    """
+
+    try:
+        await reply.edit_text(text)
+    except TelegramAPIError as e:
+        logger.warning("Failed to edit message %d in chat %d: %s", reply.message_id, reply.chat.id, e)
+        return False
+    return True
+
+
+async def _finish(reply: Message, text):
+    """Показывает итоговый текст, а если сообщение не отредактировать - отправляет новое"""
+    if not await _edit(reply, text):
+        await reply.answer(text)
+
+
+async def stream_wish(reply: Message, future, partial):
+    """
+    Ожидает генерацию и дописывает поздравление в сообщение reply,
+    редактируя его не чаще, чем раз в stream_edit_interval секунд
+    """
+
+    waiter = asyncio.ensure_future(generation_service.wait(future))
+    shown = reply.text
+    try:
+        while not waiter.done():
+            await asyncio.wait([waiter], timeout=stream_edit_interval)
+            text = partial['text'].strip()
+            if not waiter.done() and text and text != shown and await _edit(reply, text):
+                shown = text
+    finally:
+        if not waiter.done():
+            waiter.cancel()
+
+    try:
+        text = waiter.result().strip()
+    except Exception:
+        logger.exception("Wish generation failed")
+        text = ''
+    if not text:
+        # Таймаут, ошибка генерации или пустой ответ модели (например, сразу "###")
+        await _finish(reply, "Не удалось сгенерировать поздравление, попробуйте позже")
+        return
+    if text != shown:
+        await _finish(reply, text)
+
+
 @router.message(or_f(
     Command("generate_wish"),
     F.text.lower() == 'сгенерировать пожелание'
-))
-async def generate_wish(message: Message):
-    async with aiosqlite.connect("bot.db") as db:
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (message.from_user.id,))
-        user_id, _, last_generate = await cursor.fetchone()
-
-    now = datetime.now()
-    seconds_diff = (now - datetime.fromisoformat(last_generate)).total_seconds()
-
-    if seconds_diff > 60:
-        async with aiosqlite.connect("bot.db") as db:
-            await db.execute(
-                "UPDATE users SET last_generation = ? WHERE user_id = ?",
-                (now.isoformat(), user_id)
-            )
-            await db.commit()
-        await message.answer('Генерирую...')
-        await message.answer(generate())
+), flags={"throttling": "generate"})
+async def generate_wish(message: Message, command: CommandObject = None):
+    options = parse_options(command.args if command else None)
+    # В пуле лежат поздравления без персональных параметров
+    if not any(options.values()):
+        wish = wish_pool.take()
+        if wish is not None:
+            await message.answer(wish)
+            return
+        options = None
+
+    if not model_loaded.is_set():
+        await message.answer('Модель еще загружается, поздравление будет чуть позже')
+    if not await wait_model():
+        await message.answer('Генерация поздравлений сейчас недоступна, попробуйте позже')
+        return
+
+    partial = {'text': ''}
+
+    def on_text(text):
+        partial['text'] = text
+
+    try:
+        future, position = generation_service.submit(generate_streaming, on_text, options)
+    except QueueFullError:
+        await message.answer("Сейчас слишком много запросов, попробуйте позже")
+        return
 
+    if position:
+        reply = await message.answer(f'Генерирую... Вы {position}-й в очереди')
     else:
-        await message.answer(
-            "В целях безопасности бота генерация ограничена.\n" \
-            "Вы можете генерировать не чаще, чем 1 раз в 60 секунд."
-        )
+        reply = await message.answer('Генерирую...')
+    await stream_wish(reply, future, partial)
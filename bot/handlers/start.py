@@ -4,8 +4,7 @@ from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 from bot.keyboards.start_buttons import get_start_buttons
 from aiogram.filters import or_f
-import datetime
-import aiosqlite
+from bot import db
 
 
 router = Router()
@@ -24,7 +23,15 @@ help_text = """
 
 /show_dates - Показать имеющиеся даты
 
-/generate_wish - Сгенерировать поздравление прямо сейчас
+/upcoming - Показать Дни Рождения на этой неделе
+
+/export - Выгрузить даты в файл (csv, ics или vcf)
+
+/timezone - Указать часовой пояс для напоминаний
+
+/generate_wish - Сгенерировать поздравление прямо сейчас.
+Можно указать имя, кем человек вам приходится, тон (теплое, смешное, официальное, трогательное)
+и длину (короткое, длинное), например: /generate_wish Анна, подруга, смешное, короткое
 
 /help - Вывести справку по работе с ботом  
 
@@ -33,27 +40,15 @@ help_text = """
 Например,
 7 ноября = 07.11,
 11 марта = 11.03
+
+Чтобы добавить много дат сразу, отправьте файл .csv (имя и дата в строке),
+.ics (календарь) или .vcf (контакты).
 """
 
 
 @router.message(Command('start'))
 async def start(message: Message, state: FSMContext):
-    async with aiosqlite.connect("./bot.db") as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO users (user_id, chat_id, last_generation) VALUES (?, ?, ?)",
-            (message.from_user.id, message.chat.id, datetime.datetime(2000, 1, 1).isoformat())
-        )
-        await db.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS user_{message.from_user.id} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT,
-                name TEXT,
-                UNIQUE(date, name)
-            )
-            """
-        )
-        await db.commit()
+    await db.add_user(message.from_user.id, message.chat.id)
     await message.answer(help_text, parse_mode="HTML")
     await message.answer(
         "Выберите действие",
@@ -0,0 +1,63 @@
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from bot import db
+
+
+router = Router()
+usage_text = (
+    "Укажите часовой пояс как смещение от UTC или название, например:\n"
+    "/timezone +3\n"
+    "/timezone Europe/Moscow"
+)
+
+
+def parse_timezone(text):
+    """
+    Разбирает часовой пояс пользователя
+
+    Args:
+        text (str) : Смещение от UTC в часах ("+3", "UTC-5") или название IANA ("Europe/Moscow")
+
+    Returns:
+        str | None : Название часового пояса или None, если он не распознан
+    """
+
+    text = text.strip()
+    offset = text.upper().removeprefix('UTC').removeprefix('GMT')
+    if offset.lstrip('+-').isdigit():
+        hours = int(offset)
+        if not -12 <= hours <= 14:
+            return None
+        # В зонах Etc/GMT знак смещения инвертирован: Etc/GMT-3 = UTC+3
+        return 'Etc/GMT' + (f'{-hours:+d}' if hours else '')
+
+    try:
+        ZoneInfo(text)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+    return text
+
+
+def format_timezone(timezone):
+    if timezone.startswith('Etc/GMT'):
+        offset = timezone.removeprefix('Etc/GMT')
+        return 'UTC' + (f'{-int(offset):+d}' if offset else '')
+    return timezone
+
+
+@router.message(Command("timezone"), flags={"throttling": "dates"})
+async def set_timezone(message: Message, command: CommandObject):
+    if not command.args:
+        timezone = await db.get_timezone(message.from_user.id)
+        await message.answer(f"Ваш часовой пояс: {format_timezone(timezone)}\n\n{usage_text}")
+        return
+
+    timezone = parse_timezone(command.args)
+    if timezone is None:
+        await message.answer(f"Не удалось распознать часовой пояс.\n\n{usage_text}")
+        return
+
+    await db.set_timezone(message.from_user.id, timezone)
+    await message.answer(f"Часовой пояс установлен: {format_timezone(timezone)}")
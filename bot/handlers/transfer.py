@@ -0,0 +1,63 @@
+from aiogram import Router, F, Bot
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.types import Message, BufferedInputFile
+from bot import db
+from bot.handlers.dates import user_today, today_day
+from bot.utils.contacts import parse_birthdays, write_birthdays, file_format, FORMATS, MAX_NAME_LENGTH
+
+
+router = Router()
+MAX_FILE_SIZE = 1024 * 1024
+
+
+@router.message(StateFilter(None), F.document, flags={"throttling": "dates"})
+async def import_dates(message: Message, bot: Bot):
+    document_format = file_format(message.document.file_name)
+    if document_format is None:
+        await message.answer("Поддерживаются файлы .csv, .ics и .vcf")
+        return
+    if message.document.file_size and message.document.file_size > MAX_FILE_SIZE:
+        await message.answer("Файл слишком большой, максимальный размер - 1 МБ")
+        return
+
+    stream = await bot.download(message.document)
+    entries = []
+    seen = set()
+    invalid = repeated = 0
+    for date, name in parse_birthdays(stream, document_format):
+        name = name.strip()
+        if date is None or not name or len(name) > MAX_NAME_LENGTH:
+            invalid += 1
+        elif (date, name) in seen:
+            repeated += 1
+        else:
+            seen.add((date, name))
+            entries.append((date, name))
+
+    report = await db.import_birthdays(message.from_user.id, entries)
+    await message.answer(
+        f"Добавлено дат: {report['added']}\n"
+        f"Уже были в списке: {report['existing']}\n"
+        f"Повторы в файле: {repeated}\n"
+        f"Некорректные строки: {invalid}\n"
+        f"Не поместились в лимит: {report['over_quota']}"
+    )
+
+
+@router.message(Command("export"), flags={"throttling": "dates"})
+async def export_dates(message: Message, command: CommandObject):
+    export_format = (command.args or 'csv').strip().lower().lstrip('.')
+    if export_format not in FORMATS:
+        await message.answer("Укажите формат: /export csv, /export ics или /export vcf")
+        return
+
+    today = await user_today(message.from_user.id)
+    data = await db.list_birthdays(message.from_user.id, today_day(today))
+    if not data:
+        await message.answer("У вас нет добавленных дат")
+        return
+
+    content = write_birthdays([(date, name) for _, date, name in data], export_format)
+    await message.answer_document(
+        BufferedInputFile(content.encode('utf-8'), filename=f"birthdays.{export_format}")
+    )
@@ -8,6 +8,7 @@ def get_start_buttons() -> ReplyKeyboardMarkup:
     kb.button(text="Удалить дату")
     kb.button(text="Сгенерировать пожелание")
     kb.button(text="Показать мои даты")
+    kb.button(text="Ближайшие даты")
     kb.button(text="Помощь")
-    kb.adjust(2, 2, 1)
+    kb.adjust(2, 2, 2)
     return kb.as_markup(resize_keyboard=True)
@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from aiohttp import ClientSession, web
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetMe, GetUpdates, SendMessage
+from aiogram.types import Message, Update, User
+from bot import db
+from bot.webhook import create_app
+from main import create_dispatcher
+
+
+class FakeSession(BaseSession):
+    """
+    Сессия, которая вместо Telegram отвечает сама, с искусственной сетевой задержкой.
+    Апдейты для getUpdates берутся из очереди updates.
+
+    Args:
+        latency (float) : Задержка каждого запроса к "Telegram", с
+    """
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.updates = deque()
+        self.requests = Counter()
+        self._message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        await asyncio.sleep(self.latency)
+        self.requests[type(method).__name__] += 1
+
+        if isinstance(method, GetUpdates):
+            batch = [self.updates.popleft() for _ in range(min(method.limit or 100, len(self.updates)))]
+            if not batch:
+                await asyncio.sleep(0.1)
+            return [Update.model_validate(update, context={"bot": bot}) for update in batch]
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="Fake", username="fake_bot")
+        if isinstance(method, SendMessage):
+            self._message_id += 1
+            return Message.model_validate({
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": method.chat_id, "type": "private"},
+                "text": method.text
+            }, context={"bot": bot})
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        """Файлы в нагрузочном тесте не скачиваются: содержимое любого файла пустое"""
+        await asyncio.sleep(self.latency)
+        self.requests["stream_content"] += 1
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class UpdateCounter:
+    """Внешняя мидлварь, которая считает обработанные апдейты и ждет, пока их станет total"""
+
+    def __init__(self, total):
+        self.total = total
+        self.handled = 0
+        self.started = None
+        self.done = asyncio.Event()
+
+    async def start(self):
+        self.started = time.perf_counter()
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.handled += 1
+            if self.handled >= self.total:
+                self.done.set()
+
+
+def make_updates(count, commands):
+    """
+    Returns:
+        list : Апдейты с сообщениями-командами от разных пользователей
+    """
+
+    updates = []
+    for update_id in range(1, count + 1):
+        user = {"id": 1000 + update_id, "is_bot": False, "first_name": "User"}
+        updates.append({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user["id"], "type": "private"},
+                "from": user,
+                "text": commands[update_id % len(commands)]
+            }
+        })
+    return updates
+
+
+async def bench_polling(args, updates):
+    session = FakeSession(args.latency)
+    session.updates.extend(updates)
+    bot = Bot("42:FAKE", session=session)
+    counter = UpdateCounter(len(updates))
+    dp = create_dispatcher(startup=(counter.start,))
+    dp.update.outer_middleware(counter)
+
+    polling = asyncio.create_task(dp.start_polling(
+        bot, handle_signals=False, tasks_concurrency_limit=args.max_in_flight
+    ))
+    await counter.done.wait()
+    elapsed = time.perf_counter() - counter.started
+    await dp.stop_polling()
+    await polling
+    return elapsed, session.requests
+
+
+async def bench_webhook(args, updates):
+    session = FakeSession(args.latency)
+    bot = Bot("42:FAKE", session=session)
+    counter = UpdateCounter(len(updates))
+    dp = create_dispatcher()
+    dp.update.outer_middleware(counter)
+
+    secret = "loadtest"
+    app = create_app(dp, bot, "/webhook", secret, args.max_in_flight)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    # Telegram держит не больше max_connections одновременных запросов к вебхуку
+    connections = asyncio.Semaphore(args.connections)
+    url = f"http://127.0.0.1:{args.port}/webhook"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+
+    async def post(client, update):
+        async with connections:
+            while True:
+                async with client.post(url, json=update, headers=headers) as response:
+                    # 429 - бот занят, Telegram в таком случае повторяет доставку позже
+                    if response.status != 429:
+                        response.raise_for_status()
+                        return
+                await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+    try:
+        start = time.perf_counter()
+        async with ClientSession() as client:
+            await asyncio.gather(*(post(client, update) for update in updates))
+        await counter.done.wait()
+        elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+    return elapsed, session.requests
+
+
+def run_mode(mode, args):
+    """
+    Прогоняет нагрузочный тест одного режима на временной базе данных
+
+    Returns:
+        dict : Результаты теста
+    """
+
+    updates = make_updates(args.updates, args.commands)
+    bench = bench_polling if mode == "polling" else bench_webhook
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "loadtest.db")
+        elapsed, requests = asyncio.run(bench(args, updates))
+    return {
+        "mode": mode,
+        "updates": args.updates,
+        "latency_s": args.latency,
+        "elapsed_s": round(elapsed, 2),
+        "updates_per_sec": round(args.updates / elapsed, 1),
+        "requests": dict(requests),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный тест бота на фейковом Telegram: polling против webhook'
+    )
+    parser.add_argument(
+        '--modes', type=str, nargs='+', default=["polling", "webhook"], choices=["polling", "webhook"],
+        help='Режимы для сравнения'
+    )
+    parser.add_argument('--updates', type=int, default=2000, help='Количество апдейтов')
+    parser.add_argument(
+        '--commands', type=str, nargs='+', default=["/start", "/help", "/show_dates"],
+        help='Команды в сообщениях пользователей'
+    )
+    parser.add_argument('--latency', type=float, default=0.05, help='Задержка запроса к Telegram, с')
+    parser.add_argument(
+        '--max_in_flight', type=int, default=100,
+        help='Максимальное количество одновременно обрабатываемых апдейтов'
+    )
+    parser.add_argument(
+        '--connections', type=int, default=40,
+        help='Количество одновременных запросов к вебхуку (max_connections в Telegram)'
+    )
+    parser.add_argument('--port', type=int, default=8081, help='Порт вебхука')
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        # Роутеры можно подключить только к одному диспетчеру, поэтому каждый режим в своем процессе
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_mode, mode, args).result()
+        print(json.dumps(result, ensure_ascii=False))
@@ -0,0 +1,262 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+# Если метрики выключены, все вызовы ниже почти ничего не стоят: таймеры возвращают
+# пустой контекстный менеджер, а наблюдения сразу выходят
+ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", 60))
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_NULL = nullcontext()
+_metrics = []
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Счетчик, который только растет"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        if not ENABLED:
+            return
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        for labelvalues, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, labelvalues), value
+
+    def snapshot(self):
+        return {','.join(labelvalues) or 'total': value for labelvalues, value in self._values.items()}
+
+
+class Gauge:
+    """Значение, которое может расти и уменьшаться, например глубина очереди"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._functions = {}
+        _metrics.append(self)
+
+    def set(self, value, *labelvalues):
+        if not ENABLED:
+            return
+        self._values[labelvalues] = value
+
+    def set_function(self, func, *labelvalues):
+        """Значение будет вычисляться вызовом func при каждом чтении метрик"""
+        self._functions[labelvalues] = func
+
+    def _collect(self):
+        values = dict(self._values)
+        for labelvalues, func in self._functions.items():
+            try:
+                values[labelvalues] = func()
+            except Exception:
+                continue
+        return values
+
+    def samples(self):
+        for labelvalues, value in self._collect().items():
+            yield self.name, _format_labels(self.labelnames, labelvalues), value
+
+    def snapshot(self):
+        return {','.join(labelvalues) or 'value': value for labelvalues, value in self._collect().items()}
+
+
+class Histogram:
+    """Распределение значений (обычно длительностей в секундах) по корзинам"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labelvalues -> [счетчики по корзинам, сумма, количество]
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, *labelvalues):
+        if not ENABLED:
+            return
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            entry = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, *labelvalues):
+        """
+        Returns:
+            contextmanager : Контекст, длительность которого записывается в гистограмму
+        """
+
+        if not ENABLED:
+            return _NULL
+        return self._timer(labelvalues)
+
+    @contextmanager
+    def _timer(self, labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self):
+        for labelvalues, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, ('le', bound))
+                yield self.name + '_bucket', labels, cumulative
+            labels = _format_labels(self.labelnames, labelvalues, ('le', '+Inf'))
+            yield self.name + '_bucket', labels, count
+            yield self.name + '_sum', _format_labels(self.labelnames, labelvalues), total
+            yield self.name + '_count', _format_labels(self.labelnames, labelvalues), count
+
+    def snapshot(self):
+        return {
+            ','.join(labelvalues) or 'total': {'count': count, 'avg': round(total / count, 4)}
+            for labelvalues, (_, total, count) in self._values.items()
+        }
+
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Длительность обработки сообщения хэндлером", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хэндлерах", ("handler",))
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Длительность запроса к базе данных", ("query",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+)
+MODEL_STAGE_SECONDS = Histogram("bot_model_stage_seconds", "Длительность этапов генерации", ("mode", "stage"))
+MODEL_TOKENS = Counter("bot_model_generated_tokens_total", "Сгенерированные токены", ("mode",))
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Глубина очередей", ("queue",))
+JOB_SECONDS = Histogram("bot_job_seconds", "Длительность задач планировщика", ("job",))
+
+
+@lru_cache(maxsize=256)
+def query_name(sql):
+    """Короткое имя запроса для метки: операция и таблица, например "select birthdays" """
+    operation = sql.split(None, 1)[0].lower()
+    match = re.search(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', sql, re.IGNORECASE)
+    return f'{operation} {match.group(1)}' if match else operation
+
+
+def record_generation(mode, stats):
+    """
+    Записывает тайминги генерации, собранные model.inference в словарь stats
+
+    Args:
+        mode (str) : Тип генерации: single, stream или batch
+        stats (dict | None) : tokenize, prefill, decode, detokenize в секундах и tokens
+    """
+
+    if not ENABLED or not stats:
+        return
+    for stage in ('tokenize', 'prefill', 'decode', 'detokenize'):
+        if stage in stats:
+            MODEL_STAGE_SECONDS.observe(stats[stage], mode, stage)
+    MODEL_TOKENS.inc(mode, amount=stats.get('tokens', 0))
+
+
+def render():
+    """
+    Returns:
+        str : Все метрики в текстовом формате Prometheus
+    """
+
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """
+    Returns:
+        dict : Краткая сводка метрик для структурированных логов
+    """
+
+    return {metric.name: values for metric in _metrics if (values := metric.snapshot())}
+
+
+async def handle(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+_runner = None
+_task = None
+
+
+async def serve(host, port):
+    """Поднимает отдельный HTTP сервер с эндпоинтом /metrics"""
+    global _runner
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logger.info("Metrics are served on %s:%d/metrics", host, port)
+
+
+async def start():
+    """Запускает периодическую запись сводки метрик в лог"""
+    global _task
+    if ENABLED and LOG_INTERVAL > 0:
+        _task = asyncio.create_task(_log_periodically())
+
+
+async def stop():
+    global _task, _runner
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+async def _log_periodically():
+    while True:
+        await asyncio.sleep(LOG_INTERVAL)
+        logger.info("metrics %s", json.dumps(snapshot(), ensure_ascii=False))
@@ -0,0 +1,17 @@
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+from bot import metrics
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время работы каждого хэндлера и считает исключения в нем"""
+
+    async def __call__(self, handler, event: Message, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        with metrics.HANDLER_SECONDS.time(name):
+            try:
+                return await handler(event, data)
+            except Exception:
+                metrics.HANDLER_ERRORS.inc(name)
+                raise
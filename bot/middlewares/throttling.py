@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import math
+import os
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+from bot import db
+from bot.utils.ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# Ключ флага throttling -> (количество запросов, за сколько секунд)
+LIMITS = {
+    "generate": (int(os.getenv("GENERATE_LIMIT", 1)), float(os.getenv("GENERATE_LIMIT_PERIOD", 60))),
+    "dates": (int(os.getenv("DATES_LIMIT", 10)), float(os.getenv("DATES_LIMIT_PERIOD", 60))),
+}
+MESSAGES = {
+    "generate": "В целях безопасности бота генерация ограничена.\n"
+                "Вы можете генерировать не чаще, чем {capacity} раз в {period:g} секунд.",
+}
+DEFAULT_MESSAGE = "Слишком много запросов, попробуйте через {seconds} с"
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту запросов пользователя к хэндлерам с флагом throttling.
+    Для каждой пары (пользователь, ключ флага) хранится token bucket в памяти,
+    измененные ведра периодически сохраняются в SQLite.
+
+    Args:
+        limits (dict) : Ключ флага -> (количество запросов, период в секундах)
+        flush_interval (float) : Как часто сохранять ведра в базу, с
+    """
+
+    def __init__(self, limits=LIMITS, flush_interval=30):
+        self.limits = limits
+        self.flush_interval = flush_interval
+        self._buckets = {}
+        self._dirty = set()
+        self._task = None
+
+    def _bucket(self, user_id, key):
+        bucket = self._buckets.get((user_id, key))
+        if bucket is None:
+            capacity, period = self.limits[key]
+            bucket = self._buckets[(user_id, key)] = TokenBucket(capacity, capacity / period)
+        return bucket
+
+    async def __call__(self, handler, event: Message, data):
+        key = get_flag(data, "throttling")
+        if key is None or event.from_user is None:
+            return await handler(event, data)
+
+        bucket = self._bucket(event.from_user.id, key)
+        if not bucket.consume():
+            text = MESSAGES.get(key, DEFAULT_MESSAGE)
+            capacity, period = self.limits[key]
+            await event.answer(text.format(
+                seconds=math.ceil(bucket.retry_after()), capacity=capacity, period=period
+            ))
+            return None
+        self._dirty.add((event.from_user.id, key))
+        return await handler(event, data)
+
+    async def start(self):
+        for user_id, key, tokens, updated in await db.load_throttling():
+            if key in self.limits:
+                capacity, period = self.limits[key]
+                bucket = TokenBucket(capacity, capacity / period, tokens, updated)
+                if not bucket.full:
+                    self._buckets[(user_id, key)] = bucket
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        """Сохраняет измененные ведра в базу и забывает полные"""
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for user_id, key in dirty:
+            bucket = self._buckets[(user_id, key)]
+            rows.append((user_id, key, bucket.tokens, bucket.updated))
+        if rows:
+            await db.save_throttling(rows)
+
+        for user_key, bucket in list(self._buckets.items()):
+            if user_key not in self._dirty and bucket.full:
+                del self._buckets[user_key]
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush throttling state")
@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import aiosqlite
+from bot.db import create_schema, DEFAULT_TIMEZONE, SHARDS
+from bot.utils.dates import day_of_year
+
+
+async def migrate_user_tables(db):
+    """
+    Переносит даты из старых таблиц user_<id> в общую таблицу birthdays
+    и удаляет перенесенные таблицы.
+
+    Args:
+        db (aiosqlite.Connection) : Соединение с базой данных
+
+    Returns:
+        int : Количество перенесенных таблиц
+    """
+
+    cursor = await db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'user_[0-9]*'"
+    )
+    tables = [table for table, in await cursor.fetchall()]
+
+    for table in tables:
+        user_id = int(table.removeprefix('user_'))
+        await db.execute(
+            f"""
+            INSERT OR IGNORE INTO birthdays (user_id, date, name)
+            SELECT ?, date, name FROM {table} ORDER BY id
+            """,
+            (user_id,)
+        )
+        await db.execute(f"DROP TABLE {table}")
+    await db.commit()
+    return len(tables)
+
+
+async def add_column(db, table, column, definition):
+    """
+    Добавляет столбец в таблицу, если его еще нет
+
+    Returns:
+        bool : Был ли добавлен столбец
+    """
+
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in await cursor.fetchall()]:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+async def migrate_users_columns(db):
+    """
+    Добавляет пользователям часовой пояс, шард рассылки и квоту дат.
+    Существующим пользователям ставится часовой пояс по умолчанию.
+
+    Args:
+        db (aiosqlite.Connection) : Соединение с базой данных
+    """
+
+    await add_column(db, "users", "timezone", "TEXT")
+    await add_column(db, "users", "shard", "INTEGER")
+    await add_column(db, "users", "quota", "INTEGER")
+    await db.execute(
+        "UPDATE users SET timezone = ? WHERE timezone IS NULL", (DEFAULT_TIMEZONE,)
+    )
+    await db.execute(
+        "UPDATE users SET shard = user_id % ? WHERE shard IS NULL", (SHARDS,)
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_timezone_shard ON users(timezone, shard)"
+    )
+    await db.commit()
+
+
+async def migrate_birthdays_day(db):
+    """
+    Добавляет датам номер дня года и индексы по нему
+
+    Args:
+        db (aiosqlite.Connection) : Соединение с базой данных
+    """
+
+    await add_column(db, "birthdays", "day", "INTEGER")
+    cursor = await db.execute("SELECT id, date FROM birthdays WHERE day IS NULL")
+    rows = await cursor.fetchall()
+    await db.executemany(
+        "UPDATE birthdays SET day = ? WHERE id = ?",
+        [(day_of_year(date), id) for id, date in rows]
+    )
+    await db.execute("DROP INDEX IF EXISTS idx_birthdays_date")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_day ON birthdays(day)")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_birthdays_user_day ON birthdays(user_id, day)"
+    )
+    await db.commit()
+
+
+async def migrate(db):
+    """
+    Приводит базу данных к актуальной схеме
+
+    Args:
+        db (aiosqlite.Connection) : Соединение с базой данных
+    """
+
+    await migrate_user_tables(db)
+    await migrate_users_columns(db)
+    await migrate_birthdays_day(db)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Приводит базу данных бота к актуальной схеме'
+    )
+    parser.add_argument(
+        '--db_path', type=str, default='bot.db',
+        help='Путь к базе данных'
+    )
+    args = parser.parse_args()
+
+    async def run():
+        async with aiosqlite.connect(args.db_path) as db:
+            await create_schema(db)
+            print(f"Перенесено таблиц user_<id>: {await migrate_user_tables(db)}")
+            await migrate_users_columns(db)
+            await migrate_birthdays_day(db)
+
+    asyncio.run(run())
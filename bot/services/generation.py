@@ -0,0 +1,125 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Очередь генерации переполнена"""
+
+
+class GenerationService:
+    """
+    Сервис генерации поздравлений.
+
+    Запросы складываются в ограниченную очередь и выполняются в пуле потоков,
+    поэтому инференс модели не блокирует event loop бота.
+
+    Args:
+        workers (int) : Количество потоков генерации
+        max_queue (int) : Максимальное количество запросов в очереди
+        timeout (float) : Таймаут запроса в секундах
+    """
+
+    def __init__(self, workers=1, max_queue=20, timeout=180):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._queue = None
+        self._executor = None
+        self._tasks = []
+        self._busy = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="generation"
+        )
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            future, _, _ = self._queue.get_nowait()
+            future.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def pending(self):
+        """Количество запросов в очереди и в работе"""
+        return self._queue.qsize() + self._busy
+
+    def submit(self, func, *args):
+        """
+        Ставит задачу в очередь
+
+        Args:
+            func (callable) : Синхронная функция генерации
+            *args : Аргументы функции
+
+        Returns:
+            (asyncio.Future, int) : Future с результатом и место в очереди
+                (0, если задача начнет выполняться сразу)
+
+        Raises:
+            QueueFullError : Очередь переполнена
+        """
+
+        ahead = self.pending
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((future, func, args))
+        except asyncio.QueueFull:
+            raise QueueFullError()
+        position = max(0, ahead - self.workers + 1)
+        return future, position
+
+    async def wait(self, future, timeout=None):
+        """
+        Ожидает результат задачи. По таймауту задача отменяется.
+
+        Raises:
+            asyncio.TimeoutError : Превышен таймаут
+        """
+
+        return await asyncio.wait_for(future, timeout or self.timeout)
+
+    async def run(self, func, *args, timeout=None):
+        """Ставит задачу в очередь и ожидает ее результат"""
+        future, _ = self.submit(func, *args)
+        return await self.wait(future, timeout)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            future, func, args = await self._queue.get()
+            if future.done():
+                # Запрос отменен по таймауту, пока ждал в очереди
+                self._queue.task_done()
+                continue
+
+            self._busy += 1
+            try:
+                result = await loop.run_in_executor(self._executor, func, *args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._busy -= 1
+                self._queue.task_done()
+
+
+generation_service = GenerationService(
+    workers=int(os.getenv("GENERATION_WORKERS", 1)),
+    max_queue=int(os.getenv("GENERATION_QUEUE_SIZE", 20)),
+    timeout=float(os.getenv("GENERATION_TIMEOUT", 180))
+)
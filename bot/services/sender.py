@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import time
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+    TelegramNetworkError, TelegramServerError
+)
+from bot import db
+from bot.utils.ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class Sender:
+    """
+    Очередь исходящих сообщений для массовых рассылок.
+
+    Сообщения сначала записываются в таблицу outbox, поэтому после падения бота
+    рассылка продолжается с того места, где остановилась. Отправка идет в несколько
+    потоков с общим ограничением скорости (token bucket) и паузой между сообщениями
+    в один чат. При flood-wait все отправители ждут retry_after и повторяют отправку,
+    при сетевых ошибках сообщение повторяется с экспоненциальной задержкой, а затем
+    откладывается. Из outbox сообщение удаляется, только когда оно отправлено или Telegram
+    отклонил его навсегда.
+
+    Args:
+        rate (float) : Сообщений в секунду на всего бота
+        chat_interval (float) : Минимальный интервал между сообщениями в один чат, с
+        concurrency (int) : Количество одновременных отправителей
+        max_attempts (int) : Сколько раз подряд пытаться отправить сообщение при сетевых ошибках,
+            прежде чем отложить его на retry_delay. Flood-wait попыткой не считается
+        retry_delay (float) : Через сколько секунд повторить отложенное сообщение
+    """
+
+    def __init__(self, rate=30, chat_interval=1.0, concurrency=8, max_attempts=5, retry_delay=60):
+        self.chat_interval = chat_interval
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._bucket = TokenBucket(rate, rate)
+        self._chat_slots = {}
+        self._paused_until = 0
+        self._queue = None
+        self._tasks = []
+        self._bot = None
+        self._in_flight = 0
+        self._reset_stats()
+
+    @property
+    def pending(self):
+        """Количество сообщений в очереди и в отправке"""
+        return (self._queue.qsize() if self._queue is not None else 0) + self._in_flight
+
+    @property
+    def idle(self):
+        return self._queue.empty() and self._in_flight == 0
+
+    def _reset_stats(self):
+        self.stats = {"sent": 0, "failed": 0, "retried": 0}
+        self._started = time.perf_counter()
+
+    async def start(self, bot: Bot):
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        pending = await db.pending_outbox()
+        for message in pending:
+            self._queue.put_nowait(message)
+        if pending:
+            logger.info("Resuming %d undelivered messages from outbox", len(pending))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, messages):
+        """
+        Сохраняет сообщения в outbox и ставит их в очередь на отправку
+
+        Args:
+            messages (list) : Пары (chat_id, текст)
+        """
+
+        if not messages:
+            return
+        if self.idle:
+            self._reset_stats()
+        for message in await db.add_outbox(messages):
+            self._queue.put_nowait(message)
+
+    async def _wait_for_slot(self, chat_id):
+        while not self._bucket.consume():
+            await asyncio.sleep(self._bucket.retry_after())
+
+        # Резервируем слот в чате сразу, чтобы параллельные отправители его не заняли
+        now = time.monotonic()
+        slot = max(now, self._chat_slots.get(chat_id, 0))
+        self._chat_slots[chat_id] = slot + self.chat_interval
+        if len(self._chat_slots) > 10000:
+            self._chat_slots = {
+                chat: free_at for chat, free_at in self._chat_slots.items() if free_at > now
+            }
+        await asyncio.sleep(max(slot - now, self._paused_until - now, 0))
+
+    async def _send(self, outbox_id, chat_id, text):
+        """
+        Returns:
+            bool | None : True - отправлено, False - Telegram отклонил сообщение навсегда,
+                None - не удалось отправить из-за сетевых ошибок, сообщение нужно повторить позже
+        """
+
+        attempt = 0
+        while attempt < self.max_attempts:
+            await self._wait_for_slot(chat_id)
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except TelegramRetryAfter as e:
+                # Flood-wait не считается попыткой: Telegram сам говорит, когда повторить
+                self._paused_until = time.monotonic() + e.retry_after
+                self.stats["retried"] += 1
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                logger.info("Dropping message %d to chat %d: %s", outbox_id, chat_id, e)
+                return False
+            except (TelegramNetworkError, TelegramServerError) as e:
+                self.stats["retried"] += 1
+                logger.warning("Message %d to chat %d failed: %s", outbox_id, chat_id, e)
+                await asyncio.sleep(2 ** attempt)
+                attempt += 1
+        return None
+
+    async def _worker(self):
+        while True:
+            message = await self._queue.get()
+            outbox_id, chat_id, text = message
+            self._in_flight += 1
+            try:
+                sent = await self._send(outbox_id, chat_id, text)
+                if sent is None:
+                    # Сообщение остается в outbox и снова встает в очередь через retry_delay
+                    logger.warning(
+                        "Message %d to chat %d is postponed for %.0f s", outbox_id, chat_id, self.retry_delay
+                    )
+                    asyncio.get_running_loop().call_later(self.retry_delay, self._queue.put_nowait, message)
+                else:
+                    self.stats["sent" if sent else "failed"] += 1
+                    await db.remove_outbox(outbox_id)
+            except Exception:
+                self.stats["failed"] += 1
+                logger.exception("Failed to send message %d to chat %d", outbox_id, chat_id)
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+            if self.idle:
+                elapsed = time.perf_counter() - self._started
+                logger.info(
+                    "Outbox drained: sent=%d failed=%d retried=%d in %.1f s",
+                    self.stats["sent"], self.stats["failed"], self.stats["retried"], elapsed
+                )
+                self._reset_stats()
+
+
+sender = Sender(
+    rate=float(os.getenv("SEND_RATE", 30)),
+    chat_interval=float(os.getenv("SEND_CHAT_INTERVAL", 1.0)),
+    concurrency=int(os.getenv("SEND_CONCURRENCY", 8))
+)
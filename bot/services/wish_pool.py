@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from pathlib import Path
+from bot.services.generation import generation_service
+
+
+logger = logging.getLogger(__name__)
+
+
+class WishPool:
+    """
+    Пул заранее сгенерированных поздравлений.
+
+    Фоновая задача поддерживает в пуле до size поздравлений, догенерируя их,
+    только когда очередь генерации пуста. Пул сохраняется на диск и переживает
+    перезапуск бота. Каждое поздравление выдается только один раз.
+
+    Args:
+        generate_batch (callable) : Синхронная функция, генерирующая n поздравлений
+        path (str) : Путь к json файлу пула
+        size (int) : Размер пула
+        batch_size (int) : Сколько поздравлений генерировать за раз
+        idle_interval (float) : Пауза между проверками, когда пул полон или генерация занята, с
+        ready (asyncio.Event) : Событие готовности модели, до него пул не пополняется
+    """
+
+    def __init__(self, generate_batch, path, size=20, batch_size=8, idle_interval=5, ready=None):
+        self.generate_batch = generate_batch
+        self.path = Path(path)
+        self.size = size
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.ready = ready
+        self.hits = 0
+        self.misses = 0
+        self._wishes = deque()
+        self._task = None
+
+    @property
+    def depth(self):
+        """Количество поздравлений в пуле"""
+        return len(self._wishes)
+
+    def stats(self):
+        return {"depth": self.depth, "hits": self.hits, "misses": self.misses}
+
+    async def start(self):
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf8') as f:
+                self._wishes.extend(wish for wish in json.load(f) if wish.strip())
+        if self.size > 0:
+            self._task = asyncio.create_task(self._refill())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._save()
+
+    def take(self):
+        """
+        Забирает поздравление из пула
+
+        Returns:
+            str | None : Поздравление или None, если пул пуст
+        """
+
+        wishes = self.take_many(1)
+        return wishes[0] if wishes else None
+
+    def take_many(self, n):
+        """
+        Забирает до n поздравлений из пула
+
+        Returns:
+            list : Поздравления, их может быть меньше n
+        """
+
+        wishes = [self._wishes.popleft() for _ in range(min(n, self.depth))]
+        self.hits += len(wishes)
+        self.misses += n - len(wishes)
+        if wishes:
+            self._save()
+        return wishes
+
+    def _save(self):
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(list(self._wishes), f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def _refill(self):
+        if self.ready is not None:
+            await self.ready.wait()
+        while True:
+            if self.depth >= self.size or generation_service.pending > 0:
+                await asyncio.sleep(self.idle_interval)
+                continue
+
+            n = min(self.batch_size, self.size - self.depth)
+            try:
+                wishes = await generation_service.run(self.generate_batch, n)
+            except Exception:
+                logger.exception("Wish pool refill of %d wishes failed", n)
+                await asyncio.sleep(self.idle_interval)
+                continue
+            # Пустые ответы модели (например, сразу "###") в пул не попадают
+            self._wishes.extend(wish for wish in wishes if wish.strip())
+            self._save()
+            logger.info(
+                "Wish pool refilled: depth=%d hits=%d misses=%d",
+                self.depth, self.hits, self.misses
+            )
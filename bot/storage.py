@@ -0,0 +1,101 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from bot import db
+
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite, переживающее перезапуски бота.
+
+    Чтение идет из LRU кеша в памяти, запись - сквозная: сначала в кеш, затем в базу.
+    Состояния, которые не менялись дольше ttl секунд, считаются устаревшими и удаляются.
+    Если бот запущен в нескольких процессах, кеш стоит отключить (cache_size=0),
+    иначе процесс может не увидеть состояние, записанное другим процессом.
+
+    Args:
+        ttl (float) : Время жизни состояния без изменений, с
+        cache_size (int) : Максимальное количество состояний в кеше
+        cleanup_interval (float) : Как часто удалять устаревшие состояния из базы, с
+    """
+
+    def __init__(self, ttl=24 * 60 * 60, cache_size=10000, cleanup_interval=60 * 60):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cleanup_interval = cleanup_interval
+        self._cache = OrderedDict()
+        self._task = None
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return ':'.join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny
+        ))
+
+    async def _load(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            row = await db.get_fsm(key)
+            entry = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, time.time())
+        if time.time() - entry[2] > self.ttl:
+            entry = (None, {}, time.time())
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _store(self, key, state, data):
+        self._remember(key, (state, data, time.time()))
+        if state is None and not data:
+            await db.delete_fsm(key)
+        else:
+            await db.set_fsm(key, state, json.dumps(data, ensure_ascii=False), time.time())
+
+    async def set_state(self, key: StorageKey, state=None):
+        key = self._key(key)
+        _, data, _ = await self._load(key)
+        await self._store(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey):
+        state, _, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data):
+        key = self._key(key)
+        state, _, _ = await self._load(key)
+        await self._store(key, state, dict(data))
+
+    async def get_data(self, key: StorageKey):
+        _, data, _ = await self._load(self._key(key))
+        return dict(data)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._cleanup_periodically())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _cleanup_periodically(self):
+        while True:
+            try:
+                await db.delete_expired_fsm(time.time() - self.ttl)
+            except Exception:
+                logger.exception("Failed to delete expired FSM states")
+            await asyncio.sleep(self.cleanup_interval)
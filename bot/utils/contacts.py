@@ -0,0 +1,203 @@
+import csv
+import io
+import itertools
+import re
+import uuid
+from datetime import datetime, timezone
+from bot.utils.dates import is_valid_dd_mm
+
+
+MAX_NAME_LENGTH = 50
+FORMATS = ('csv', 'ics', 'vcf')
+# Заголовок CSV, в том числе тот, что пишет write_birthdays
+CSV_HEADER_CELLS = {'name', 'date', 'birthday', 'имя', 'дата', 'день рождения'}
+
+
+def normalize_date(value):
+    """
+    Приводит дату из файла к формату "дд.мм"
+
+    Args:
+        value (str) : Дата в одном из форматов: дд.мм, дд.мм.гггг, гггг-мм-дд, ггггммдд, --ммдд, --мм-дд
+
+    Returns:
+        str | None : Дата "дд.мм" или None, если дата не распознана или некорректна
+    """
+
+    value = value.strip()
+    match = (
+        re.fullmatch(r'(\d{1,2})\.(\d{1,2})(?:\.\d{2,4})?', value)
+        or re.fullmatch(r'(?:\d{4}|-)-?(\d{2})-?(\d{2})', value)
+    )
+    if match is None:
+        return None
+    if '.' in value:
+        day, month = match.groups()
+    else:
+        month, day = match.groups()
+    date_str = f'{int(day):02d}.{int(month):02d}'
+    return date_str if is_valid_dd_mm(date_str) else None
+
+
+def _unfold(lines):
+    """Склеивает перенесенные строки iCalendar и vCard (продолжение начинается с пробела)"""
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _unescape(value):
+    return value.replace('\\n', ' ').replace('\\,', ',').replace('\\;', ';').replace('\\\\', '\\')
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace(';', '\\;')
+
+
+def _property(line):
+    """Разбирает строку "NAME;PARAM=...:value" на имя и значение"""
+    key, _, value = line.partition(':')
+    return key.split(';')[0].upper(), _unescape(value.strip())
+
+
+def parse_csv(lines):
+    """
+    Разбирает CSV со столбцами "имя, дата" или "дата, имя". Строка заголовка
+    (например, "name,date" из экспорта) пропускается. Разделитель - запятая
+    или точка с запятой, определяется по первой строке.
+
+    Yields:
+        (str | None, str) : Дата "дд.мм" (None, если не распознана) и имя
+    """
+
+    lines = iter(lines)
+    first_line = next(lines, '')
+    delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+    for index, row in enumerate(csv.reader(itertools.chain([first_line], lines), delimiter=delimiter)):
+        cells = [cell.strip() for cell in row if cell.strip()]
+        if not cells:
+            continue
+        if index == 0 and all(cell.lower() in CSV_HEADER_CELLS for cell in cells):
+            continue
+        dates = [normalize_date(cell) for cell in cells]
+        date = next((date for date in dates if date), None)
+        name = next((cell for cell, date in zip(cells, dates) if not date), '')
+        yield date, name
+
+
+def parse_ics(lines):
+    """
+    Разбирает события iCalendar: дата берется из DTSTART, имя - из SUMMARY
+
+    Yields:
+        (str | None, str) : Дата "дд.мм" (None, если не распознана) и имя
+    """
+
+    event = None
+    for line in _unfold(lines):
+        key, value = _property(line)
+        if key == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {}
+        elif key == 'END' and value.upper() == 'VEVENT' and event is not None:
+            yield normalize_date(event.get('DTSTART', '')[:8]), event.get('SUMMARY', '')
+            event = None
+        elif event is not None and key in ('DTSTART', 'SUMMARY'):
+            event[key] = value
+
+
+def parse_vcard(lines):
+    """
+    Разбирает контакты vCard: дата берется из BDAY, имя - из FN
+
+    Yields:
+        (str | None, str) : Дата "дд.мм" (None, если не распознана) и имя
+    """
+
+    card = None
+    for line in _unfold(lines):
+        key, value = _property(line)
+        if key == 'BEGIN' and value.upper() == 'VCARD':
+            card = {}
+        elif key == 'END' and value.upper() == 'VCARD' and card is not None:
+            if 'BDAY' in card:
+                yield normalize_date(card['BDAY'].split('T')[0]), card.get('FN', '')
+            card = None
+        elif card is not None and key in ('BDAY', 'FN'):
+            card[key] = value
+
+
+def file_format(file_name):
+    """
+    Returns:
+        str | None : csv, ics, vcf или None, если формат не поддерживается
+    """
+
+    extension = (file_name or '').rsplit('.', 1)[-1].lower()
+    extension = {'ical': 'ics', 'vcard': 'vcf'}.get(extension, extension)
+    return extension if extension in FORMATS else None
+
+
+def parse_birthdays(stream, file_format):
+    """
+    Построчно разбирает файл с Днями Рождения
+
+    Args:
+        stream (io.BufferedIOBase) : Бинарный поток с содержимым файла
+        file_format (str) : csv, ics или vcf
+
+    Yields:
+        (str | None, str) : Дата "дд.мм" (None, если не распознана) и имя
+    """
+
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    parser = {'csv': parse_csv, 'ics': parse_ics, 'vcf': parse_vcard}[file_format]
+    yield from parser(lines)
+
+
+def write_birthdays(rows, file_format):
+    """
+    Сохраняет Дни Рождения в файл
+
+    Args:
+        rows (list) : Пары (дата "дд.мм", имя)
+        file_format (str) : csv, ics или vcf
+
+    Returns:
+        str : Содержимое файла
+    """
+
+    output = io.StringIO()
+    if file_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(['name', 'date'])
+        writer.writerows((name, date) for date, name in rows)
+    elif file_format == 'ics':
+        output.write('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//birthday_bot//RU\r\n')
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        for date, name in rows:
+            day, month = date.split('.')
+            # UID одинаковый при повторных экспортах, чтобы календарь обновлял событие, а не дублировал
+            uid = uuid.uuid5(uuid.NAMESPACE_URL, f'birthday_bot:{date}:{name}')
+            output.write(
+                'BEGIN:VEVENT\r\n'
+                f'UID:{uid}@birthday_bot\r\n'
+                f'DTSTAMP:{stamp}\r\n'
+                f'DTSTART;VALUE=DATE:2000{month}{day}\r\n'
+                'RRULE:FREQ=YEARLY\r\n'
+                f'SUMMARY:{_escape(name)}\r\n'
+                'END:VEVENT\r\n'
+            )
+        output.write('END:VCALENDAR\r\n')
+    else:
+        for date, name in rows:
+            day, month = date.split('.')
+            output.write(f'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:{_escape(name)}\r\nBDAY:--{month}{day}\r\nEND:VCARD\r\n')
+    return output.getvalue()
@@ -0,0 +1,53 @@
+from datetime import date, datetime
+
+
+def is_valid_dd_mm(date_str):
+    if len(date_str) != 5:
+        return False
+    try:
+        datetime.strptime(date_str, "%d.%m")
+        return True
+    except ValueError:
+        return False
+
+
+def day_of_year(date_str):
+    """
+    Переводит дату "дд.мм" в номер дня года. Номер считается по високосному году,
+    чтобы у 29.02 тоже был свой номер, а даты сортировались по календарю.
+
+    Args:
+        date_str (str) : Дата в формате "дд.мм"
+
+    Returns:
+        int : Номер дня от 1 до 366
+    """
+
+    day, month = map(int, date_str.split('.'))
+    return date(2000, month, day).timetuple().tm_yday
+
+
+def days_until(date_str, today):
+    """
+    Считает, сколько дней осталось до ближайшего наступления даты
+
+    Args:
+        date_str (str) : Дата в формате "дд.мм"
+        today (datetime.date) : Сегодняшняя дата
+
+    Returns:
+        int : Количество дней, 0 - сегодня
+    """
+
+    day, month = map(int, date_str.split('.'))
+    year = today.year
+    while True:
+        try:
+            next_date = date(year, month, day)
+        except ValueError:
+            # 29.02 в невисокосный год
+            year += 1
+            continue
+        if next_date >= today:
+            return (next_date - today).days
+        year += 1
@@ -0,0 +1,103 @@
+import random
+from pathlib import Path
+
+
+PROMPTS_PATH = Path(__file__).parent.parent.parent / "data/raw/prompts.txt"
+# Если data/raw/prompts.txt нет, используются стили из примера в README
+FALLBACK_STYLES = [
+    "Напиши тёплое поздравление с Днём рождения",
+    "Составь искреннее пожелание на День рождения",
+    "Придумай доброе поздравление без клише",
+    "Сгенерируй позитивное пожелание ко Дню рождения",
+]
+TONES = {
+    "теплое": "в теплом тоне",
+    "смешное": "с юмором",
+    "официальное": "в официальном тоне",
+    "трогательное": "трогательно",
+}
+# Длина -> (как попросить модель, максимальное количество токенов ответа, максимум предложений)
+LENGTHS = {
+    "короткое": ("коротко, в 2-3 предложения", 100, 3),
+    "длинное": ("развернуто", 250, None),
+}
+DEFAULT_MAX_NEW_TOKENS = 250
+# Генерация останавливается на новом блоке "###" или когда ответ стал длиннее MAX_WISH_CHARS
+STOP_SEQUENCES = ("###",)
+MAX_WISH_CHARS = 1000
+MAX_OPTION_LENGTH = 50
+
+
+def load_styles(path=PROMPTS_PATH):
+    """
+    Загружает стили инструкций из txt файла с промптами (строки через пустую строку)
+
+    Returns:
+        list : Стили инструкций
+    """
+
+    try:
+        with open(path, 'r', encoding='utf8') as f:
+            styles = [line.strip() for line in f.read().replace('\xa0', ' ').split('\n\n')]
+    except OSError:
+        return list(FALLBACK_STYLES)
+    return [style for style in styles if style] or list(FALLBACK_STYLES)
+
+
+def parse_options(text):
+    """
+    Разбирает параметры поздравления из аргументов команды, например "Анна, подруга, смешное".
+    Тон и длина узнаются по словам из TONES и LENGTHS в любом месте,
+    остальные параметры по порядку - имя и кем человек приходится.
+
+    Args:
+        text (str | None) : Параметры через запятую
+
+    Returns:
+        dict : name, relationship, tone, length (отсутствующие - None)
+    """
+
+    options = dict(name=None, relationship=None, tone=None, length=None)
+    rest = []
+    for part in (text or '').split(','):
+        part = part.strip()[:MAX_OPTION_LENGTH]
+        if part.lower() in TONES:
+            options['tone'] = part.lower()
+        elif part.lower() in LENGTHS:
+            options['length'] = part.lower()
+        elif part:
+            rest.append(part)
+    if rest:
+        options['name'] = rest[0]
+    if len(rest) > 1:
+        options['relationship'] = rest[1]
+    return options
+
+
+def build_prompt(style=None, name=None, relationship=None, tone=None, length=None):
+    """
+    Собирает промпт из общего префикса (инструкция в одном из стилей) и персонального суффикса.
+    Префиксов столько же, сколько стилей, поэтому их past_key_values можно кешировать.
+
+    Returns:
+        (str, str, dict) : Префикс, суффикс и ограничения ответа для генерации:
+            max_new_tokens и условия ранней остановки stop
+    """
+
+    prefix = f"### Instruction: {style or random.choice(FALLBACK_STYLES)}"
+    details = []
+    recipient = ' '.join(part for part in (relationship, name) if part)
+    if recipient:
+        details.append(f"получатель - {recipient}")
+    if tone:
+        details.append(TONES[tone])
+    max_new_tokens, max_sentences = DEFAULT_MAX_NEW_TOKENS, None
+    if length:
+        instruction, max_new_tokens, max_sentences = LENGTHS[length]
+        details.append(instruction)
+    suffix = (", " + ", ".join(details) if details else "") + "\n### Response:"
+    limits = dict(
+        max_new_tokens=max_new_tokens,
+        stop=dict(stop_sequences=STOP_SEQUENCES, max_sentences=max_sentences, max_chars=MAX_WISH_CHARS)
+    )
+    return prefix, suffix, limits
@@ -0,0 +1,54 @@
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket: в ведре до capacity токенов, за секунду добавляется rate токенов.
+    Время берется из time.time(), чтобы состояние можно было сохранить и восстановить после перезапуска.
+
+    Args:
+        capacity (float) : Вместимость ведра
+        rate (float) : Скорость пополнения, токенов в секунду
+        tokens (float) : Начальное количество токенов. По умолчанию ведро полное
+        updated (float) : Время последнего пополнения
+    """
+
+    def __init__(self, capacity, rate, tokens=None, updated=None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def consume(self, amount=1):
+        """
+        Забирает токены, если их достаточно. Проверка и списание выполняются
+        без точек переключения event loop, поэтому атомарны для корутин.
+
+        Returns:
+            bool : Удалось ли забрать токены
+        """
+
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def retry_after(self, amount=1):
+        """
+        Returns:
+            float : Через сколько секунд можно будет забрать токены
+        """
+
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
@@ -0,0 +1,72 @@
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+class InFlightLimiter:
+    """
+    Ограничивает количество апдейтов, принятых по вебхуку, но еще не обработанных.
+
+    aiohttp мидлварь считает принятые запросы к пути вебхука, а внешняя мидлварь апдейтов
+    диспетчера - завершенные. Когда лимит исчерпан, вебхук отвечает 429, и Telegram
+    повторяет доставку апдейта позже. Рассчитан на обработку апдейтов в фоне
+    (handle_in_background=True в SimpleRequestHandler), когда ответ 200 означает,
+    что апдейт принят, но еще не обработан.
+
+    Args:
+        path (str) : Путь вебхука
+        max_in_flight (int) : Максимальное количество одновременно обрабатываемых апдейтов
+    """
+
+    def __init__(self, path, max_in_flight=100):
+        self.path = path
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        if request.path != self.path:
+            return await handler(request)
+        if self.in_flight >= self.max_in_flight:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+
+        self.in_flight += 1
+        try:
+            response = await handler(request)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        if response.status != 200:
+            # Апдейт не принят (например, неверный секрет) и до диспетчера не дойдет
+            self.in_flight -= 1
+        return response
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+
+
+def create_app(dp: Dispatcher, bot: Bot, path, secret_token=None, max_in_flight=100):
+    """
+    Создает aiohttp приложение, принимающее апдейты по вебхуку
+
+    Args:
+        dp (Dispatcher) : Диспетчер с хэндлерами
+        bot (Bot) : Бот
+        path (str) : Путь вебхука, например /webhook
+        secret_token (str | None) : Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+        max_in_flight (int) : Максимальное количество одновременно обрабатываемых апдейтов
+
+    Returns:
+        aiohttp.web.Application : Приложение
+    """
+
+    limiter = InFlightLimiter(path, max_in_flight)
+    dp.update.outer_middleware(limiter)
+    app = web.Application(middlewares=[limiter.middleware])
+    SimpleRequestHandler(dp, bot, handle_in_background=True, secret_token=secret_token).register(app, path=path)
+    app["webhook_limiter"] = limiter
+    setup_application(app, dp, bot=bot)
+    return app
@@ -1,43 +1,141 @@
 import os
+import time
 import asyncio
-import aiosqlite
+import logging
 from aiogram import Bot
 from aiogram import Dispatcher
 from aiogram.types import BotCommand
-from bot.handlers import start, generate, dates
+from bot.handlers import start, generate, dates, transfer, timezone as timezone_handlers
+from bot.services.generation import generation_service
+from bot.services.sender import sender
+from bot.utils.dates import day_of_year
+from bot import db
+from bot.migrate import migrate
+from bot.middlewares.throttling import ThrottlingMiddleware
+from bot.middlewares.metrics import MetricsMiddleware
+from bot import metrics
+from bot.storage import SQLiteStorage
+from bot.webhook import create_app
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 
 
-async def birthday_wish(bot: Bot):
-    async with aiosqlite.connect("./bot.db") as db:
-        cursor = await db.execute("SELECT * FROM users")
-        data = await cursor.fetchall()
+logger = logging.getLogger(__name__)
+NOTIFY_HOUR = int(os.getenv("NOTIFY_HOUR", 7))
+MAX_UPDATES_IN_FLIGHT = int(os.getenv("MAX_UPDATES_IN_FLIGHT", 100))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8000))
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "1") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 8000))
 
-    today = datetime.today().strftime("%d.%m")
-    for user_id, chat_id, _ in data:
-        async with aiosqlite.connect("./bot.db") as db:
-            cursor = await db.execute(f"SELECT * FROM user_{user_id} WHERE date = ?", (today,))
-            user_data = await cursor.fetchall()
 
-        for _, _, name in user_data:
-            wish = f"{name} сегодня празднует День Рождения! Не забудьте поздравить!\n\n"
-            wish += "Текст поздравления:\n"
-            wish += generate.generate()
-            await bot.send_message(chat_id=chat_id, text=wish)
+async def send_wishes(birthdays, wishes=()):
+    """
+    Ставит в очередь напоминания о Днях Рождения. Если поздравлений меньше, чем именинников
+    (генерация не удалась), остальным отправляется напоминание без текста поздравления.
+
+    Args:
+        birthdays (list) : Пары (chat_id, имя)
+        wishes (list) : Поздравления
+    """
+
+    messages = []
+    for i, (chat_id, name) in enumerate(birthdays):
+        wish = f"{name} сегодня празднует День Рождения! Не забудьте поздравить!"
+        text = wishes[i].strip() if i < len(wishes) else ''
+        if text:
+            wish += "\n\nТекст поздравления:\n" + text
+        messages.append((chat_id, wish))
+    await sender.enqueue(messages)
+
+
+async def birthday_wish(birthdays):
+    pooled = generate.wish_pool.take_many(len(birthdays))
+    await send_wishes(birthdays, pooled)
+    birthdays = birthdays[len(pooled):]
+    if birthdays and not await generate.wait_model():
+        # Модель не загрузилась: напоминания уходят без текста поздравления
+        await send_wishes(birthdays)
+        birthdays = []
+
+    start_time = time.perf_counter()
+    generated = 0
+    for i in range(0, len(birthdays), generate.batch_size):
+        batch = birthdays[i:i + generate.batch_size]
+        try:
+            wishes = await generation_service.run(
+                generate.generate_batch, len(batch), [name for _, name in batch]
+            )
+        except Exception:
+            # Таймаут, переполненная очередь или ошибка модели: напоминание важнее поздравления,
+            # поэтому оно уходит и без текста
+            logger.exception("Birthday batch of %d wishes failed", len(batch))
+            wishes = []
+        generated += len(wishes)
+        await send_wishes(batch, wishes)
+
+    elapsed = time.perf_counter() - start_time
+    metrics.JOB_SECONDS.observe(elapsed, "birthday_wish")
+    logger.info(
+        "Birthday wishes: %d from pool, %d generated in %.1f s (%.2f wishes/sec)",
+        len(pooled), generated, elapsed, generated / elapsed if generated else 0
+    )
+
+
+_last_tick = None
+_birthday_tasks = set()
+
+
+async def birthday_shard():
+    """
+    Рассылает напоминания очередному шарду пользователей.
+    Запускается каждую минуту: пользователь получает напоминание в NOTIFY_HOUR:shard
+    по своему часовому поясу, поэтому рассылка распределена по часу в каждом поясе.
+
+    Если запуск опоздал или был пропущен, шарды пропущенных минут (не больше чем за час)
+    обрабатываются в следующем. Поздравления генерируются в фоновых задачах,
+    поэтому запуск не ждет генерацию и не накладывается на следующий.
+    """
+
+    global _last_tick
+    with metrics.JOB_SECONDS.time("birthday_shard"):
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        minute = now
+        if _last_tick is not None:
+            minute = max(_last_tick + timedelta(minutes=1), now - timedelta(minutes=59))
+        _last_tick = max(now, _last_tick or now)
+        user_timezones = await db.user_timezones()
+        while minute <= now:
+            for user_timezone in user_timezones:
+                local_now = minute.astimezone(ZoneInfo(user_timezone))
+                if local_now.hour != NOTIFY_HOUR:
+                    continue
+                birthdays = await db.shard_birthdays(
+                    user_timezone, local_now.minute, day_of_year(local_now.strftime("%d.%m"))
+                )
+                if birthdays:
+                    task = asyncio.create_task(birthday_wish(birthdays))
+                    _birthday_tasks.add(task)
+                    task.add_done_callback(_birthday_tasks.discard)
+            minute += timedelta(minutes=1)
+
+
+async def stop_birthday_tasks():
+    for task in list(_birthday_tasks):
+        task.cancel()
+    await asyncio.gather(*_birthday_tasks, return_exceptions=True)
 
 
 async def db_init():
-    async with aiosqlite.connect("./bot.db") as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            chat_id INTEGER,
-            last_generation TEXT
-        )
-        """)
-        await db.commit()
+    await db.connect()
+    await migrate(db.connection)
 
 
 async def set_default_commands(bot: Bot):
@@ -47,32 +145,116 @@ async def set_default_commands(bot: Bot):
         BotCommand(command="add_date", description="Добавить дату"),
         BotCommand(command="remove_date", description="Удалить дату"),
         BotCommand(command="show_dates", description="Показать мои даты"),
+        BotCommand(command="upcoming", description="Дни Рождения на этой неделе"),
+        BotCommand(command="export", description="Выгрузить даты в файл"),
+        BotCommand(command="timezone", description="Часовой пояс"),
         BotCommand(command="help", description="Помощь")
     ]
     await bot.set_my_commands(commands)
 
 
-async def main():
-    bot = Bot(token=os.getenv("BOT_TOKEN"))
-    dp = Dispatcher()
-    scheduler = AsyncIOScheduler()
+def create_dispatcher(startup=(), shutdown=()):
+    """
+    Создает диспетчер с хэндлерами, мидлварями и хранилищем FSM.
+    База данных подключается при старте диспетчера.
+
+    Args:
+        startup (tuple) : Функции, которые нужно вызвать при старте после подключения к базе
+        shutdown (tuple) : Функции, которые нужно вызвать при остановке до закрытия базы
+
+    Returns:
+        Dispatcher : Диспетчер
+    """
+
+    storage = SQLiteStorage(
+        ttl=float(os.getenv("FSM_TTL", 24 * 60 * 60)),
+        cache_size=int(os.getenv("FSM_CACHE_SIZE", 10000))
+    )
+    dp = Dispatcher(storage=storage)
 
     dp.include_router(start.router)
     dp.include_router(generate.router)
     dp.include_router(dates.router)
+    dp.include_router(transfer.router)
+    dp.include_router(timezone_handlers.router)
+    if metrics.ENABLED:
+        dp.message.middleware(MetricsMiddleware())
+    throttling = ThrottlingMiddleware()
+    dp.message.middleware(throttling)
     dp.startup.register(db_init)
+    dp.startup.register(throttling.start)
+    dp.startup.register(storage.start)
+    dp.startup.register(metrics.start)
+    for callback in startup:
+        dp.startup.register(callback)
+    for callback in shutdown:
+        dp.shutdown.register(callback)
+    dp.shutdown.register(metrics.stop)
+    dp.shutdown.register(throttling.stop)
+    dp.shutdown.register(storage.close)
+    dp.shutdown.register(db.close)
+    return dp
+
+
+async def run_polling(bot: Bot, dp: Dispatcher):
+    await bot.delete_webhook(drop_pending_updates=True)
+    if metrics.ENABLED:
+        await metrics.serve(METRICS_HOST, METRICS_PORT)
+    await dp.start_polling(bot, tasks_concurrency_limit=MAX_UPDATES_IN_FLIGHT)
+
 
-    scheduler.add_job(
-        birthday_wish,
-        trigger=CronTrigger(hour=7, minute=0),
-        kwargs={'bot': bot}
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, webhook requests are not verified")
+    app = create_app(dp, bot, WEBHOOK_PATH, WEBHOOK_SECRET, MAX_UPDATES_IN_FLIGHT)
+    if metrics.ENABLED:
+        app.router.add_get("/metrics", metrics.handle)
+        metrics.QUEUE_DEPTH.set_function(lambda: app["webhook_limiter"].in_flight, "webhook")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(MAX_UPDATES_IN_FLIGHT, 100),
+            drop_pending_updates=True
+        )
+        logger.info("Webhook server is listening on %s:%d%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def main():
+    bot = Bot(token=os.getenv("BOT_TOKEN"))
+    dp = create_dispatcher(
+        startup=(generation_service.start, generate.start_loading, generate.wish_pool.start, sender.start),
+        shutdown=(stop_birthday_tasks, sender.stop, generate.wish_pool.stop, generation_service.stop)
     )
-    scheduler.start()
+    metrics.QUEUE_DEPTH.set_function(lambda: generation_service.pending, "generation")
+    metrics.QUEUE_DEPTH.set_function(lambda: sender.pending, "outbox")
+    metrics.QUEUE_DEPTH.set_function(lambda: generate.wish_pool.depth, "wish_pool")
+
+    if RUN_SCHEDULER:
+        scheduler = AsyncIOScheduler()
+        scheduler.add_job(
+            birthday_shard,
+            trigger=CronTrigger(minute='*'),
+            # Пропущенные минуты наверстывает следующий запуск, см. birthday_shard
+            max_instances=1,
+            coalesce=True,
+            misfire_grace_time=60
+        )
+        scheduler.start()
 
     await set_default_commands(bot)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if WEBHOOK_URL:
+        await run_webhook(bot, dp)
+    else:
+        await run_polling(bot, dp)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
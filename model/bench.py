@@ -0,0 +1,312 @@
+import argparse
+import json
+import multiprocessing
+import resource
+import subprocess
+import time
+import numpy as np
+import psutil
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+from inference import prepare_merged_model_and_tokenizer, resolve_backend, quantize_int8, StepTimer
+from inference import PrefixCache, encode_prompt, generate_response
+from inference import DEFAULT_STOP
+from inference import BACKENDS, GENERATION_PARAMS
+
+
+MODEL_ID = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+
+def rss_mb():
+    """Текущий RSS процесса в МБ"""
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в МБ"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def git_commit():
+    """Хеш текущего коммита, чтобы сравнивать прогоны между коммитами"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_tiny_model_and_tokenizer(tokenizer_path, backend):
+    """
+    Создает маленькую случайно инициализированную Llama для локальных прогонов без обученной модели
+
+    Args:
+        tokenizer_path (pathlib.Path | str) : Путь или ID токенайзера
+        backend (str) : Бэкенд инференса
+
+    Returns:
+        (LlamaForCausalLM, AutoTokenizer) : Модель и токенайзер
+    """
+
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=256,
+        intermediate_size=688,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=1024
+    )
+    backend = resolve_backend(backend)
+    model = LlamaForCausalLM(config).to(torch.bfloat16 if backend == "bf16" else torch.float32)
+    model.eval()
+    if backend == "int8":
+        model = quantize_int8(model)
+    return model, tokenizer
+
+
+def bench_latency(model, tokenizer, prompt, runs, max_new_tokens):
+    """
+    Замеряет обработку промпта, время до первого токена, скорость декодирования
+    и перцентили полной задержки генерации
+
+    Returns:
+        dict : Результаты замера
+    """
+
+    inputs = tokenizer(prompt, return_tensors="pt")
+    prompt_tokens = inputs["input_ids"].shape[1]
+
+    prefill, ttft, decode_speed, latency = [], [], [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(**inputs)
+        prefill.append(time.perf_counter() - start)
+
+        timer = StepTimer()
+        start = time.perf_counter()
+        model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            stopping_criteria=[timer],
+            pad_token_id=tokenizer.eos_token_id,
+            **GENERATION_PARAMS
+        )
+        end = time.perf_counter()
+        latency.append(end - start)
+        ttft.append(timer.steps[0] - start)
+        decode_speed.append((len(timer.steps) - 1) / (timer.steps[-1] - timer.steps[0]))
+
+    return {
+        "prompt_tokens": prompt_tokens,
+        "new_tokens": max_new_tokens,
+        "prefill_ms": round(1000 * float(np.mean(prefill)), 2),
+        "ttft_ms": round(1000 * float(np.mean(ttft)), 2),
+        "tokens_per_sec": round(float(np.mean(decode_speed)), 2),
+        "latency_p50_s": round(float(np.percentile(latency, 50)), 3),
+        "latency_p95_s": round(float(np.percentile(latency, 95)), 3),
+        "latency_p99_s": round(float(np.percentile(latency, 99)), 3),
+    }
+
+
+def bench_batch_scaling(model, tokenizer, prompt, batch_sizes, max_new_tokens):
+    """
+    Замеряет суммарную скорость генерации в зависимости от размера батча
+
+    Returns:
+        list : Результаты для каждого размера батча
+    """
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    results = []
+    for batch_size in batch_sizes:
+        inputs = tokenizer(
+            [prompt] * batch_size, return_tensors="pt", padding=True, padding_side="left"
+        )
+        start = time.perf_counter()
+        model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id,
+            **GENERATION_PARAMS
+        )
+        elapsed = time.perf_counter() - start
+        results.append({
+            "batch_size": batch_size,
+            "latency_s": round(elapsed, 3),
+            "tokens_per_sec": round(batch_size * max_new_tokens / elapsed, 2),
+        })
+    return results
+
+
+def bench_prefix_cache(model, tokenizer, prefix, suffix, runs):
+    """
+    Сравнивает время до первого токена для промпта prefix + suffix
+    с полной обработкой промпта и с закешированным префиксом
+
+    Returns:
+        dict : Результаты замера
+    """
+
+    results = {}
+    for name, prefix_cache in (("full_prefill", None), ("prefix_cache", PrefixCache())):
+        # Прогрев, заодно заполняет кеш префиксов
+        model.generate(
+            **encode_prompt(model, tokenizer, suffix, prefix, prefix_cache),
+            max_new_tokens=1, pad_token_id=tokenizer.eos_token_id
+        )
+        ttft = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model.generate(
+                **encode_prompt(model, tokenizer, suffix, prefix, prefix_cache),
+                max_new_tokens=1, pad_token_id=tokenizer.eos_token_id
+            )
+            ttft.append(time.perf_counter() - start)
+        results[f"{name}_ttft_ms"] = round(1000 * float(np.mean(ttft)), 2)
+    return results
+
+
+def bench_early_stopping(model, tokenizer, prompt, runs, max_new_tokens, max_sentences=None):
+    """
+    Сравнивает генерацию до max_new_tokens или EOS с ранней остановкой по стоп-последовательностям
+    (и, если задано, по количеству предложений). Оба варианта генерируются с одинаковым seed,
+    поэтому до остановки они совпадают, и разница - это сэкономленные токены
+
+    Returns:
+        dict : Среднее количество токенов и задержка без остановки и с ней
+    """
+
+    stop = dict(DEFAULT_STOP, max_sentences=max_sentences)
+    results = {}
+    for name, condition in (("no_stop", None), ("early_stop", stop)):
+        tokens, latency = [], []
+        for run in range(runs):
+            torch.manual_seed(run)
+            stats = {}
+            start = time.perf_counter()
+            generate_response(model, tokenizer, prompt, max_new_tokens, stats=stats, stop=condition)
+            latency.append(time.perf_counter() - start)
+            tokens.append(stats["tokens"])
+        results[f"{name}_tokens"] = round(float(np.mean(tokens)), 1)
+        results[f"{name}_latency_s"] = round(float(np.mean(latency)), 3)
+    results["tokens_saved"] = round(results["no_stop_tokens"] - results["early_stop_tokens"], 1)
+    results["latency_saved_s"] = round(results["no_stop_latency_s"] - results["early_stop_latency_s"], 3)
+    return results
+
+
+@torch.inference_mode()
+def run_suite(backend, args):
+    """
+    Прогоняет все замеры для одного бэкенда
+
+    Args:
+        backend (str) : Бэкенд инференса
+        args (argparse.Namespace) : Аргументы запуска
+
+    Returns:
+        dict : Результаты замеров
+    """
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    start = time.perf_counter()
+    if args.tiny:
+        tokenizer_path = args.merged_path if Path(args.merged_path).exists() else MODEL_ID
+        model, tokenizer = prepare_tiny_model_and_tokenizer(tokenizer_path, backend)
+    else:
+        model, tokenizer = prepare_merged_model_and_tokenizer(
+            args.merged_path, backend, args.threads, args.quantized_path
+        )
+    load_time = time.perf_counter() - start
+    rss_loaded = rss_mb()
+
+    # Прогрев
+    model.generate(
+        **tokenizer(args.prompt, return_tensors="pt"),
+        max_new_tokens=8,
+        pad_token_id=tokenizer.eos_token_id
+    )
+
+    return {
+        "backend": resolve_backend(backend),
+        "model": "tiny" if args.tiny else str(args.merged_path),
+        "threads": torch.get_num_threads(),
+        "load_time_s": round(load_time, 2),
+        "rss_mb": round(rss_loaded, 1),
+        **bench_latency(model, tokenizer, args.prompt, args.runs, args.max_new_tokens),
+        "batch_scaling": bench_batch_scaling(
+            model, tokenizer, args.prompt, args.batch_sizes, args.max_new_tokens
+        ),
+        "prefix_cache": bench_prefix_cache(model, tokenizer, args.prompt, args.suffix, args.runs),
+        "early_stopping": bench_early_stopping(
+            model, tokenizer, args.prompt + args.suffix, args.runs, args.max_new_tokens, args.max_sentences
+        ),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+if __name__ == '__main__':
+    project_dir = Path(__file__).parent.parent
+    parser = argparse.ArgumentParser(
+        description='Бенчмарк инференса TinyLLama'
+    )
+    parser.add_argument(
+        '--backends', type=str, nargs='+', default=["auto"], choices=BACKENDS,
+        help='Бэкенды для сравнения'
+    )
+    parser.add_argument(
+        '--tiny', action='store_true',
+        help='Использовать маленькую случайно инициализированную Llama вместо обученной модели'
+    )
+    parser.add_argument(
+        '--prompt', type=str, default="### Instruction: Напиши подравление c Днем Рождения",
+        help='Промпт'
+    )
+    parser.add_argument(
+        '--suffix', type=str, default=", получатель - подруга Анна, с юмором\n### Response:",
+        help='Персональный суффикс промпта для замера кеша префиксов'
+    )
+    parser.add_argument(
+        '--max_sentences', type=int, default=None,
+        help='Ограничение количества предложений для замера ранней остановки'
+    )
+    parser.add_argument('--runs', type=int, default=10, help='Количество замеров')
+    parser.add_argument('--max_new_tokens', type=int, default=64, help='Количество генерируемых токенов')
+    parser.add_argument(
+        '--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8],
+        help='Размеры батча для замера масштабирования'
+    )
+    parser.add_argument('--threads', type=int, default=None, help='Количество потоков torch')
+    parser.add_argument(
+        '--merged_path', type=str, default=project_dir / "tinyllama/merged",
+        help='Путь к обученной модели'
+    )
+    parser.add_argument(
+        '--quantized_path', type=str, default=project_dir / "tinyllama/quantized",
+        help='Путь к квантованной модели'
+    )
+    parser.add_argument('--output', type=str, default=None, help='Путь к json файлу с результатами')
+    args = parser.parse_args()
+
+    report = {"commit": git_commit(), "runs": args.runs, "results": []}
+    for backend in args.backends:
+        # Каждый бэкенд в отдельном процессе, чтобы замеры памяти не смешивались
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_suite, backend, args).result()
+        report["results"].append(result)
+        print(json.dumps(result, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import re
+import numpy as np
+import xxhash
+
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+WORD_RE = re.compile(r'\w+')
+
+# Параметры MinHash в процессе-воркере, задаются в _init_worker
+_worker = {}
+
+
+def normalize(text):
+    """Текст в нижнем регистре без знаков препинания и лишних пробелов"""
+    return ' '.join(WORD_RE.findall(text.lower().replace('ё', 'е')))
+
+
+def shingles(text, size=5):
+    """
+    Returns:
+        set : Символьные n-граммы длины size (короткий текст - одна n-грамма)
+    """
+
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def permutations(num_perm, seed=42):
+    """
+    Returns:
+        (np.ndarray, np.ndarray) : Коэффициенты a и b хеш-функций (a * x + b) mod p
+    """
+
+    generator = np.random.RandomState(seed)
+    a = generator.randint(1, MAX_HASH, size=num_perm, dtype=np.uint64)
+    b = generator.randint(0, MAX_HASH, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash(text, a, b, shingle_size=5):
+    """
+    Returns:
+        np.ndarray : MinHash сигнатура нормализованного текста длины len(a)
+    """
+
+    hashes = np.fromiter(
+        (xxhash.xxh32_intdigest(shingle.encode('utf-8')) for shingle in shingles(text, shingle_size)),
+        dtype=np.uint64
+    )
+    # 32-битные хеши и коэффициенты, поэтому a * x + b помещается в uint64 без переполнения
+    values = ((np.outer(hashes, a) + b) % MERSENNE_PRIME) & MAX_HASH
+    return values.min(axis=0).astype(np.uint32)
+
+
+def lsh_params(threshold, num_perm):
+    """
+    Выбирает разбиение сигнатуры на bands полос по rows значений. Пары с похожестью выше
+    (1 / bands) ** (1 / rows) почти наверняка попадут в одну корзину хотя бы в одной полосе,
+    поэтому берется наибольший такой порог, не превышающий threshold: кандидаты все равно
+    проверяются по сигнатурам, а пропущенные пары уже не вернуть.
+
+    Returns:
+        (int, int) : bands и rows
+    """
+
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    fitting = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold]
+    return max(fitting, key=lambda option: (1 / option[0]) ** (1 / option[1])) if fitting else options[0]
+
+
+class UnionFind:
+    """Система непересекающихся множеств, корень кластера - его самый ранний элемент"""
+
+    def __init__(self):
+        self.parent = []
+
+    def add(self):
+        self.parent.append(len(self.parent))
+
+    def find(self, x):
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parent[max(x, y)] = min(x, y)
+
+
+def _init_worker(num_perm, shingle_size, seed):
+    _worker.update(permutations=permutations(num_perm, seed), shingle_size=shingle_size)
+
+
+def _signature(text):
+    normalized = normalize(text)
+    if not normalized:
+        return None, None
+    a, b = _worker['permutations']
+    key = xxhash.xxh64_intdigest(normalized.encode('utf-8'))
+    return key, minhash(normalized, a, b, _worker['shingle_size'])
+
+
+def find_duplicates(texts, threshold=0.8, num_perm=128, shingle_size=5, workers=None, seed=42, chunksize=256):
+    """
+    Находит точные и почти точные дубликаты за один проход по текстам.
+
+    Сигнатуры MinHash считаются в пуле из workers процессов. Точные дубликаты (совпадает
+    нормализованный текст) находятся по хешу, остальные тексты раскладываются LSH по корзинам,
+    и текст объединяется в кластер с первым текстом корзины, если оценка их похожести
+    по Жаккару не меньше threshold. Время работы линейно по количеству текстов.
+
+    Args:
+        texts (Iterable[str]) : Тексты
+        threshold (float) : Порог похожести по Жаккару для почти точных дубликатов
+        num_perm (int) : Длина сигнатуры MinHash
+        shingle_size (int) : Длина символьных n-грамм
+        workers (int | None) : Количество процессов. По умолчанию по числу ядер
+        seed (int) : Сид хеш-функций
+
+    Returns:
+        (list, dict, dict) : Флаги "оставить" для каждого текста (первый текст каждого кластера),
+            размеры кластеров с дубликатами по индексу оставленного текста и статистика
+    """
+
+    bands, rows = lsh_params(threshold, num_perm)
+    tables = [{} for _ in range(bands)]
+    exact = {}
+    signatures = []
+    empty = set()
+    clusters = UnionFind()
+    stats = dict(total=0, empty=0, exact_duplicates=0, candidates=0, bands=bands, rows=rows)
+
+    with multiprocessing.Pool(
+        workers or os.cpu_count(), initializer=_init_worker, initargs=(num_perm, shingle_size, seed)
+    ) as pool:
+        for index, (key, signature) in enumerate(pool.imap(_signature, texts, chunksize)):
+            clusters.add()
+            signatures.append(None)
+            stats['total'] += 1
+            if key is None:
+                empty.add(index)
+                continue
+            if key in exact:
+                clusters.union(exact[key], index)
+                stats['exact_duplicates'] += 1
+                continue
+            exact[key] = index
+            signatures[index] = signature
+            for band, table in enumerate(tables):
+                first = table.setdefault(signature[band * rows:(band + 1) * rows].tobytes(), index)
+                if first == index or clusters.find(first) == clusters.find(index):
+                    continue
+                stats['candidates'] += 1
+                if np.count_nonzero(signatures[first] == signature) >= threshold * num_perm:
+                    clusters.union(first, index)
+
+    sizes = {}
+    for index in range(stats['total']):
+        if index not in empty:
+            root = clusters.find(index)
+            sizes[root] = sizes.get(root, 0) + 1
+    keep = [index not in empty and clusters.find(index) == index for index in range(stats['total'])]
+    duplicates = {root: size for root, size in sizes.items() if size > 1}
+
+    stats['empty'] = len(empty)
+    stats['kept'] = len(sizes)
+    stats['near_duplicates'] = stats['total'] - stats['empty'] - stats['kept'] - stats['exact_duplicates']
+    stats['clusters'] = len(duplicates)
+    stats['largest_cluster'] = max(duplicates.values(), default=1)
+    histogram = {}
+    for size in duplicates.values():
+        histogram[size] = histogram.get(size, 0) + 1
+    stats['cluster_sizes'] = dict(sorted(histogram.items()))
+    return keep, duplicates, stats
@@ -1,11 +1,230 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, StoppingCriteria, DynamicCache
 from peft import PeftModel
+from collections import OrderedDict
+from threading import Lock, Thread
+import copy
+import re
 import torch
+import time
 import argparse
 from pathlib import Path
 
 
-def generate_response(model, tokenizer, prompt, max_new_tokens=250):
+BACKENDS = ("auto", "bf16", "fp32", "int8")
+QUANTIZED_CHECKPOINT = "model_int8.pt"
+
+GENERATION_PARAMS = dict(
+    do_sample=True,
+    temperature=0.25,
+    top_p=0.95,
+    repetition_penalty=1.1
+)
+# Модель обучена на блоках "### Instruction: ... ### Response: ...",
+# поэтому новый "###" после ответа означает, что ответ закончился
+DEFAULT_STOP = dict(stop_sequences=("###",))
+SENTENCE_END = re.compile(r'[.!?…](?=\s)')
+
+
+class StepTimer(StoppingCriteria):
+    """
+    Критерий остановки, который ничего не останавливает,
+    а только запоминает время генерации каждого токена
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.steps.append(time.perf_counter())
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def _fill_stats(stats, start, tokenized, timer, generated, end, tokens):
+    """
+    Записывает в stats длительности этапов генерации в секундах:
+    tokenize, prefill (до первого токена), decode, detokenize, а также количество токенов
+    """
+
+    first_token = timer.steps[0] if timer.steps else generated
+    stats.update(
+        tokenize=tokenized - start,
+        prefill=first_token - tokenized,
+        decode=generated - first_token,
+        detokenize=end - generated,
+        tokens=tokens
+    )
+
+
+class StopOnText(StoppingCriteria):
+    """
+    Останавливает генерацию строки батча, когда в сгенерированном тексте появилась
+    стоп-последовательность (например, начало нового блока "###"), набралось max_sentences
+    законченных предложений или max_chars символов. Текст декодируется только из новых токенов.
+
+    Args:
+        tokenizer (AutoTokenizer) : Токенайзер
+        prompt_length (int) : Длина промпта в токенах
+        stop_sequences (tuple) : Стоп-последовательности
+        max_sentences (int | None) : Максимальное количество предложений
+        max_chars (int | None) : Максимальное количество символов
+    """
+
+    def __init__(self, tokenizer, prompt_length, stop_sequences=(), max_sentences=None, max_chars=None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_sequences = stop_sequences
+        self.max_sentences = max_sentences
+        self.max_chars = max_chars
+        self.done = None
+
+    def _should_stop(self, text):
+        if any(sequence in text for sequence in self.stop_sequences):
+            return True
+        if self.max_chars is not None and len(text) >= self.max_chars:
+            return True
+        return self.max_sentences is not None and len(SENTENCE_END.findall(text)) >= self.max_sentences
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for row in (~self.done).nonzero().flatten().tolist():
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            if self._should_stop(text):
+                self.done[row] = True
+        return self.done.clone()
+
+
+def trim_response(text, stop=None):
+    """
+    Обрезает ответ по тем же условиям, по которым StopOnText останавливает генерацию:
+    до первой стоп-последовательности, не больше max_sentences предложений и max_chars символов
+
+    Args:
+        text (str) : Ответ сети
+        stop (dict | None) : stop_sequences, max_sentences, max_chars
+
+    Returns:
+        str : Обрезанный ответ
+    """
+
+    if not stop:
+        return text.strip()
+    for sequence in stop.get("stop_sequences", ()):
+        text = text.split(sequence, 1)[0]
+    max_sentences = stop.get("max_sentences")
+    if max_sentences is not None:
+        ends = list(SENTENCE_END.finditer(text))
+        if len(ends) >= max_sentences:
+            text = text[:ends[max_sentences - 1].start() + 1]
+    max_chars = stop.get("max_chars")
+    if max_chars is not None and len(text) > max_chars:
+        text = text[:max_chars]
+        # Режем по последнему законченному предложению, а если его нет - по слову
+        ends = list(SENTENCE_END.finditer(text + ' '))
+        cut = ends[-1].start() + 1 if ends else text.rfind(' ')
+        text = text[:cut] if cut > 0 else text
+    return text.strip()
+
+
+def _safe_length(text, stop):
+    """Длина текста без хвоста, который может оказаться началом стоп-последовательности"""
+    for sequence in (stop or {}).get("stop_sequences", ()):
+        for size in range(min(len(sequence) - 1, len(text)), 0, -1):
+            if text.endswith(sequence[:size]):
+                return len(text) - size
+    return len(text)
+
+
+def _stopping_criteria(tokenizer, prompt_length, stop, timer=None):
+    criteria = []
+    if timer is not None:
+        criteria.append(timer)
+    if stop:
+        criteria.append(StopOnText(tokenizer, prompt_length, **stop))
+    return criteria or None
+
+
+class PrefixCache:
+    """
+    Кеш past_key_values для общих префиксов промптов (например, "### Instruction: <стиль>").
+    Префикс прогоняется через модель один раз, а при генерации модель обрабатывает
+    только новый суффикс промпта. Хранит не больше size префиксов, вытесняя самые старые.
+
+    Args:
+        size (int) : Максимальное количество префиксов в кеше
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @torch.inference_mode()
+    def _prefill(self, model, tokenizer, prefix):
+        input_ids = tokenizer(prefix, return_tensors="pt")["input_ids"].to(model.device)
+        cache = model(input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        return input_ids, cache
+
+    @torch.inference_mode()
+    def encode(self, model, tokenizer, prefix, suffix):
+        """
+        Returns:
+            dict : input_ids и attention_mask всего промпта и копия past_key_values префикса,
+                если токены префикса совпадают с началом токенов промпта
+        """
+
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None:
+                self._entries.move_to_end(prefix)
+                self.hits += 1
+        if entry is None:
+            entry = self._prefill(model, tokenizer, prefix)
+            with self._lock:
+                self.misses += 1
+                self._entries[prefix] = entry
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+
+        prefix_ids, cache = entry
+        inputs = tokenizer(prefix + suffix, return_tensors="pt").to(model.device)
+        # Промпт токенизируется целиком, как при обучении и в generate_batch. Кеш подходит,
+        # только если токены префикса - начало токенов промпта (на стыке токены могут склеиться)
+        # и после префикса остается хотя бы один токен
+        length = prefix_ids.shape[1]
+        input_ids = inputs["input_ids"]
+        if input_ids.shape[1] > length and torch.equal(input_ids[:, :length], prefix_ids):
+            # generate дописывает кеш, поэтому каждой генерации нужна своя копия
+            inputs["past_key_values"] = copy.deepcopy(cache)
+        return inputs
+
+
+def encode_prompt(model, tokenizer, prompt, prefix=None, prefix_cache=None):
+    """
+    Токенизирует промпт prefix + prompt целиком. С prefix_cache к нему добавляются
+    закешированные past_key_values префикса
+
+    Args:
+        model (AutoModelForCausalLM) : Модель
+        tokenizer (AutoTokenizer) : Токенайзер
+        prompt (str) : Промпт или его суффикс, если передан prefix
+        prefix (str | None) : Общий префикс промпта
+        prefix_cache (PrefixCache | None) : Кеш префиксов
+
+    Returns:
+        dict : Аргументы для model.generate
+    """
+
+    if prefix is not None and prefix_cache is not None:
+        return prefix_cache.encode(model, tokenizer, prefix, prompt)
+    return tokenizer((prefix or '') + prompt, return_tensors="pt").to(model.device)
+
+
+@torch.inference_mode()
+def generate_response(model, tokenizer, prompt, max_new_tokens=250, stats=None, prefix=None, prefix_cache=None,
+                      stop=DEFAULT_STOP):
     """
     Генерирует ответ сети на промпт
 
@@ -15,25 +234,175 @@ def generate_response(model, tokenizer, prompt, max_new_tokens=250):
         prompt (str) : Промпт
         max_new_tokens (int) : Максимальное количество токенов ответа сети.
             По умолчанию : 250
+        stats (dict | None) : Если передан, в него записываются тайминги этапов генерации
+        prefix (str | None) : Общий префикс промпта, тогда prompt - его продолжение
+        prefix_cache (PrefixCache | None) : Кеш префиксов, чтобы не обрабатывать prefix заново
+        stop (dict | None) : Условия ранней остановки, см. StopOnText. None - генерировать
+            до max_new_tokens или EOS
 
     Returns:
-        str : Ответ сети
+        str : Ответ сети (без промпта)
     """
 
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    start = time.perf_counter()
+    inputs = encode_prompt(model, tokenizer, prompt, prefix, prefix_cache)
+    prompt_length = inputs["input_ids"].shape[1]
+    timer = StepTimer()
+    tokenized = time.perf_counter()
     outputs = model.generate(
         **inputs,
         max_new_tokens=max_new_tokens,
-        do_sample=True,
-        temperature=0.25,
-        top_p=0.95,
-        repetition_penalty=1.1,
-        pad_token_id=tokenizer.eos_token_id
+        pad_token_id=tokenizer.eos_token_id,
+        stopping_criteria=_stopping_criteria(tokenizer, prompt_length, stop, timer if stats is not None else None),
+        **GENERATION_PARAMS
     )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    generated = time.perf_counter()
+    response = trim_response(tokenizer.decode(outputs[0, prompt_length:], skip_special_tokens=True), stop)
+    if stats is not None:
+        tokens = outputs.shape[1] - prompt_length
+        _fill_stats(stats, start, tokenized, timer, generated, time.perf_counter(), tokens)
     return response
 
 
+def generate_stream(model, tokenizer, prompt, max_new_tokens=250, stats=None, prefix=None, prefix_cache=None,
+                    stop=DEFAULT_STOP):
+    """
+    Генерирует ответ сети на промпт по частям.
+    Генерация идет в отдельном потоке, куски текста отдаются по мере декодирования токенов.
+
+    Args:
+        model (AutoModelForCausalLM) : Модель
+        tokenizer (AutoTokenizer) : Токенайзер
+        prompt (str) : Промпт
+        max_new_tokens (int) : Максимальное количество токенов ответа сети.
+            По умолчанию : 250
+        stats (dict | None) : Если передан, в него записываются тайминги этапов генерации.
+            Детокенизация идет вместе с декодированием и входит в decode
+        prefix (str | None) : Общий префикс промпта, тогда prompt - его продолжение
+        prefix_cache (PrefixCache | None) : Кеш префиксов, чтобы не обрабатывать prefix заново
+        stop (dict | None) : Условия ранней остановки, см. StopOnText
+
+    Yields:
+        str : Очередной кусок ответа сети (без промпта)
+    """
+
+    start = time.perf_counter()
+    inputs = encode_prompt(model, tokenizer, prompt, prefix, prefix_cache)
+    prompt_length = inputs["input_ids"].shape[1]
+    timer = StepTimer()
+    tokenized = time.perf_counter()
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    @torch.inference_mode()
+    def run(**kwargs):
+        # Если generate упадет, стример не получит сигнал конца, и цикл ниже зависнет,
+        # поэтому стример завершается здесь, а ошибка пробрасывается после цикла
+        try:
+            model.generate(**kwargs)
+        except BaseException as e:
+            errors.append(e)
+            streamer.end()
+
+    thread = Thread(
+        target=run,
+        kwargs=dict(
+            **inputs,
+            streamer=streamer,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.eos_token_id,
+            stopping_criteria=_stopping_criteria(
+                tokenizer, prompt_length, stop, timer if stats is not None else None
+            ),
+            **GENERATION_PARAMS
+        )
+    )
+    thread.start()
+    # Стример успевает отдать текст до того, как сработает остановка,
+    # поэтому отдается только обрезанный текст без возможного начала стоп-последовательности
+    text, emitted = '', ''
+    for chunk in streamer:
+        text += chunk
+        trimmed = trim_response(text, stop)
+        ready = trimmed[:_safe_length(trimmed, stop)]
+        if len(ready) > len(emitted) and ready.startswith(emitted):
+            yield ready[len(emitted):]
+            emitted = ready
+    thread.join()
+    if errors:
+        raise errors[0]
+    trimmed = trim_response(text, stop)
+    if len(trimmed) > len(emitted) and trimmed.startswith(emitted):
+        yield trimmed[len(emitted):]
+    if stats is not None:
+        generated = time.perf_counter()
+        _fill_stats(stats, start, tokenized, timer, generated, generated, len(timer.steps))
+        del stats["detokenize"]
+
+
+@torch.inference_mode()
+def generate_batch(model, tokenizer, prompts, batch_size=8, max_new_tokens=250, stats=None, stop=DEFAULT_STOP):
+    """
+    Генерирует ответы сети на список промптов батчами.
+    Промпты в батче выравниваются паддингом слева, паддинг маскируется attention mask.
+    Каждая строка батча останавливается по stop отдельно, батч - когда остановятся все.
+
+    Args:
+        model (AutoModelForCausalLM) : Модель
+        tokenizer (AutoTokenizer) : Токенайзер
+        prompts (list) : Список промптов
+        batch_size (int) : Размер батча.
+            По умолчанию : 8
+        max_new_tokens (int) : Максимальное количество токенов ответа сети.
+            По умолчанию : 250
+        stats (dict | None) : Если передан, в него записываются тайминги этапов генерации,
+            просуммированные по батчам
+        stop (dict | None) : Условия ранней остановки, см. StopOnText
+
+    Returns:
+        list : Ответы сети (без промптов) в порядке промптов
+    """
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    responses = []
+    for i in range(0, len(prompts), batch_size):
+        start = time.perf_counter()
+        inputs = tokenizer(
+            prompts[i:i + batch_size],
+            return_tensors="pt",
+            padding=True,
+            padding_side="left"
+        ).to(model.device)
+        prompt_length = inputs["input_ids"].shape[1]
+        timer = StepTimer()
+        tokenized = time.perf_counter()
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=_stopping_criteria(
+                tokenizer, prompt_length, stop, timer if stats is not None else None
+            ),
+            **GENERATION_PARAMS
+        )
+        generated = time.perf_counter()
+        new_tokens = outputs[:, prompt_length:]
+        responses += [
+            trim_response(text, stop) for text in tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        ]
+        if stats is not None:
+            batch_stats = {}
+            _fill_stats(
+                batch_stats, start, tokenized, timer, generated, time.perf_counter(),
+                int((new_tokens != tokenizer.pad_token_id).sum())
+            )
+            for stage, value in batch_stats.items():
+                stats[stage] = stats.get(stage, 0) + value
+    return responses
+
+
 def prepare_finetuned_model_and_tokenizer(model_id, finetuned_path):
     """
     Загружает обученную модель отдельно с LoRa
@@ -56,23 +425,117 @@ def prepare_finetuned_model_and_tokenizer(model_id, finetuned_path):
     return model, tokenizer
 
 
-def prepare_merged_model_and_tokenizer(merged_path):
+def cpu_supports_bf16():
+    """
+    Проверяет аппаратную поддержку bfloat16 процессором (AVX512-BF16 или AMX).
+    Без нее вычисления в bfloat16 на CPU эмулируются и медленнее, чем в float32.
+
+    Returns:
+        bool : Есть ли поддержка bfloat16
+    """
+
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def resolve_backend(backend):
+    """
+    Выбирает конкретный бэкенд инференса
+
+    Args:
+        backend (str) : Один из BACKENDS. "auto" выбирает bf16 или fp32 по возможностям процессора
+
+    Returns:
+        str : bf16, fp32 или int8
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if backend == "auto":
+        return "bf16" if cpu_supports_bf16() else "fp32"
+    return backend
+
+
+def quantize_int8(model):
+    """
+    Динамически квантует Linear слои модели в int8
+
+    Args:
+        model (AutoModelForCausalLM) : Модель в float32
+
+    Returns:
+        AutoModelForCausalLM : Квантованная модель
+    """
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def save_quantized(model, quantized_path):
+    """
+    Сохраняет квантованную модель, чтобы не квантовать ее при каждом запуске
+
+    Args:
+        model (AutoModelForCausalLM) : Квантованная модель
+        quantized_path (pathlib.Path) : Директория для сохранения
+    """
+
+    quantized_path = Path(quantized_path)
+    quantized_path.mkdir(parents=True, exist_ok=True)
+    torch.save(model, quantized_path / QUANTIZED_CHECKPOINT)
+
+
+def prepare_merged_model_and_tokenizer(merged_path, backend="auto", num_threads=None, quantized_path=None,
+                                       timings=None):
     """
     Загружает обученную модель, совмещенную с LoRa
 
     Args:
         merged_path (pathlib.Path) : Путь к обученной модели
+        backend (str) : Бэкенд инференса: auto, bf16, fp32 или int8.
+            По умолчанию : auto
+        num_threads (int) : Количество потоков torch. По умолчанию не меняется
+        quantized_path (pathlib.Path) : Директория с заранее квантованной моделью для int8.
+            Если модели там нет, она квантуется при загрузке
+        timings (dict) : Если передан, в него записывается время загрузки
+            токенайзера ("tokenizer") и весов ("weights") в секундах
 
     Returns:
         AutoModelForCausalLM, AutoTokenizer) : Модель и токенайзер
     """
-    
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    backend = resolve_backend(backend)
+
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
     tokenizer = AutoTokenizer.from_pretrained(merged_path)
-    model = AutoModelForCausalLM.from_pretrained(
-        merged_path,
-        torch_dtype=torch.bfloat16,
-        device_map="cpu"
-    )
+    timings['tokenizer'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if backend == "int8" and quantized_path and (Path(quantized_path) / QUANTIZED_CHECKPOINT).exists():
+        model = torch.load(
+            Path(quantized_path) / QUANTIZED_CHECKPOINT, weights_only=False, mmap=True
+        )
+    else:
+        # Веса из safetensors отображаются в память, а не копируются в нее
+        model = AutoModelForCausalLM.from_pretrained(
+            merged_path,
+            torch_dtype=torch.bfloat16 if backend == "bf16" else torch.float32,
+            device_map="cpu",
+            use_safetensors=True,
+            low_cpu_mem_usage=True
+        )
+        if backend == "int8":
+            model = quantize_int8(model)
+    model.eval()
+    timings['weights'] = time.perf_counter() - start
     return model, tokenizer
 
 
@@ -83,11 +546,29 @@ if __name__ == '__main__':
         '--prompt', type=str, default="Напиши подравление c Днем Рождения",
         help='Prompt'
     )
+    parser.add_argument(
+        '--backend', type=str, default="auto", choices=BACKENDS,
+        help='Бэкенд инференса'
+    )
+    parser.add_argument(
+        '--threads', type=int, default=None,
+        help='Количество потоков torch'
+    )
+    parser.add_argument(
+        '--save_quantized', action='store_true',
+        help='Сохранить int8 модель в tinyllama/quantized'
+    )
     args = parser.parse_args()
 
     merged_path = project_dir / "tinyllama/merged"
-    model, tokenizer = prepare_merged_model_and_tokenizer(merged_path)
-    model.eval() 
+    quantized_path = project_dir / "tinyllama/quantized"
+    model, tokenizer = prepare_merged_model_and_tokenizer(
+        merged_path, args.backend, args.threads, quantized_path
+    )
+    if args.save_quantized:
+        if resolve_backend(args.backend) != "int8":
+            model = quantize_int8(model.float())
+        save_quantized(model, quantized_path)
 
-    response = generate_response(model, tokenizer, "### Instruction: " + args.prompt)
+    response = generate_response(model, tokenizer, "### Instruction: " + args.prompt + "\n### Response:")
     print(response)
@@ -1,47 +1,69 @@
 import argparse
+import asyncio
+import hashlib
+import itertools
 import random
 import json
-import os
-import tqdm
-import requests
-import time
-from bs4 import BeautifulSoup
+import torch
 from pathlib import Path
 from datasets import Dataset
+from scraper import scrape_wishes
+from dedup import find_duplicates
 
 
 SEED = 42
+RESPONSE_MARKER = "### Response:"
+IGNORE_INDEX = -100
+TOKENIZATION_MODES = ("max_length", "dynamic", "packing")
 
 
-def parse_wishes(wishes_path, url, base_url):
+def parse_wishes(wishes_path, url, base_url, pages=180, concurrency=4, interval=0.5, fresh=False):
     """
-    Парсит пожелания с сайта Поздравок
+    Парсит пожелания с сайта Поздравок. Если парсинг прервался,
+    повторный запуск продолжит его с последней скачанной страницы.
 
     Args:
         wishes_path (pathlib.Path) : Путь к txt файлу для сохранения поздравлений
         url (str) : URL страницы для парсинга
         base_url (str) : URL главной страницы сайта
+        pages (int) : Количество страниц
+        concurrency (int) : Максимальное количество одновременных запросов
+        interval (float) : Минимальный интервал между запросами к сайту, с
+        fresh (bool) : Начать парсинг заново
     """
 
-    if os.path.exists(wishes_path):
-        os.remove(wishes_path)
+    stats = asyncio.run(scrape_wishes(
+        wishes_path, url, base_url, pages, concurrency, interval, fresh=fresh
+    ))
+    print(
+        f"Страниц: {stats['pages']}, новых поздравлений: {stats['wishes']}, "
+        f"дубликатов: {stats['duplicates']}"
+    )
 
-    f = open(wishes_path, 'w+')
-    for _ in tqdm.tqdm(range(180), desc='Parsing'):
-        time.sleep(random.uniform(0.5, 1))
-        response = requests.get(url)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        data = soup.find('div', {'class': 'content'})
-        data = data.find_all('p')
 
-        for wish in data:
-            f.write(wish.get_text() + '\n\n')
+def iter_records(txt_path):
+    """
+    Построчно читает txt файл и отдает записи, разделенные пустыми строками,
+    не загружая файл в память целиком
 
-        next_url = soup.find('div', {'class': 'pages_next'})
-        next_url = next_url.find('a', href=True)['href']
-        url = base_url + next_url
-        response.close()
-    f.close()
+    Args:
+        txt_path (pathlib.Path) : Путь к txt файлу
+
+    Yields:
+        str : Очередная запись
+    """
+
+    lines = []
+    with open(txt_path, 'r', encoding='utf8') as f:
+        for line in f:
+            line = line.replace('\xa0', ' ').rstrip('\n')
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                yield '\n'.join(lines)
+                lines = []
+    if lines:
+        yield '\n'.join(lines)
 
 
 def txt2list(txt_path):
@@ -54,17 +76,62 @@ def txt2list(txt_path):
     Returns:
         list : список пожеланий
     """
-    with open(txt_path, 'r') as f:
-        data = f.read()
-        data = data.replace('\xa0', ' ')
-        result = data.split('\n\n')
-    return result
+    return list(iter_records(txt_path))
+
+
+def dedup_wishes(wishes_path, output_path, threshold=0.8, num_perm=128, workers=None):
+    """
+    Удаляет из поздравлений точные и почти точные дубликаты (MinHash + LSH, см. dedup.py)
+    и сохраняет оставшиеся в output_path в том же формате. Из каждого кластера дубликатов
+    остается первое поздравление.
+
+    Args:
+        wishes_path (pathlib.Path) : Путь к txt файлу с поздравлениями
+        output_path (pathlib.Path) : Путь к txt файлу для поздравлений без дубликатов
+        threshold (float) : Порог похожести по Жаккару для почти точных дубликатов
+        num_perm (int) : Длина сигнатуры MinHash
+        workers (int | None) : Количество процессов. По умолчанию по числу ядер
+
+    Returns:
+        dict : Статистика кластеров дубликатов
+    """
+
+    keep, duplicates, stats = find_duplicates(iter_records(wishes_path), threshold, num_perm, workers=workers)
+    largest = sorted(duplicates, key=duplicates.get, reverse=True)[:5]
+    examples = {}
+    with open(output_path, 'w', encoding='utf8') as f:
+        for index, wish in enumerate(iter_records(wishes_path)):
+            if keep[index]:
+                f.write(wish + '\n\n')
+            if index in largest:
+                examples[index] = wish
+
+    print(json.dumps(stats, ensure_ascii=False))
+    for index in largest:
+        print(f"Кластер из {duplicates[index]}: {examples[index][:100]}")
+    return stats
+
+
+def iter_examples(wishes_path, prompts_path):
+    """
+    Составляет примеры для обучения, по очереди назначая поздравлениям перемешанные промпты,
+    поэтому ответы равномерно распределяются по промптам. В памяти держатся только промпты.
+
+    Yields:
+        str : Пример "### Instruction: ...\n### Response: ..."
+    """
+
+    prompts = txt2list(prompts_path)
+    random.shuffle(prompts)
+    for i, wish in enumerate(iter_records(wishes_path)):
+        yield f"### Instruction: {prompts[i % len(prompts)]}\n### Response: {wish}"
 
 
 def raw2json(wishes_path, prompts_path, json_path):
     """
     Создает датасет из поздравлений в формате json.
     Количество ответов (поздравлений) равномерно распределяется по промптам.
+    Файл пишется по мере чтения поздравлений.
 
     Args:
         wishes_path (pathlib.Path) : Путь к txt файлу с сохраненными поздравлений
@@ -72,55 +139,235 @@ def raw2json(wishes_path, prompts_path, json_path):
         json_path (pathlib.Path) : Путь к датасету
     """
 
-    wishes = txt2list(wishes_path)
-    random.shuffle(wishes)
+    with open(json_path, 'w', encoding='utf8') as f:
+        f.write('{')
+        for i, example in enumerate(iter_examples(wishes_path, prompts_path)):
+            f.write(', ' if i else '')
+            f.write(f'"prompt_{i}": {json.dumps(example, ensure_ascii=False)}')
+        f.write('}')
 
-    prompts = txt2list(prompts_path)
-    random.shuffle(prompts)
 
-    json_data = dict()
-    wishes_per_prompt = len(wishes) // len(prompts)
-    for i, prompt in enumerate(prompts):
-        for j in range(wishes_per_prompt):
-            curr_example = i * wishes_per_prompt + j
-            wish = wishes[curr_example]
-            json_data[f'prompt_{curr_example}'] = \
-                f"### Instruction: {prompt}\n" + \
-                f"### Response: {wish}"
+def raw2jsonl(wishes_path, prompts_path, output_dir, shard_size=10000):
+    """
+    Создает датасет из поздравлений в виде шардов jsonl по shard_size примеров.
+    Шарды пишутся по мере чтения поздравлений, поэтому память не растет с размером корпуса.
+
+    Args:
+        wishes_path (pathlib.Path) : Путь к txt файлу с сохраненными поздравлениями
+        prompts_path (pathlib.Path) : Путь к txt файлу с промптами для модели
+        output_dir (pathlib.Path) : Директория для шардов
+        shard_size (int) : Количество примеров в шарде
 
-    with open(json_path, 'w', encoding='utf8') as f:
-        json.dump(json_data, f, ensure_ascii=False)
+    Returns:
+        list : Пути к шардам
+    """
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for old_shard in output_dir.glob('*.jsonl'):
+        old_shard.unlink()
+
+    shards, f = [], None
+    try:
+        for i, example in enumerate(iter_examples(wishes_path, prompts_path)):
+            if i % shard_size == 0:
+                if f is not None:
+                    f.close()
+                shards.append(output_dir / f'shard-{len(shards):05d}.jsonl')
+                f = open(shards[-1], 'w', encoding='utf8')
+            f.write(json.dumps({"text": example}, ensure_ascii=False) + '\n')
+    finally:
+        if f is not None:
+            f.close()
+    return shards
+
+
+def _file_hash(path):
+    """sha256 содержимого файла, читается по частям"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _iter_json_texts(json_path, file_hash=None):
+    # file_hash не используется: он нужен в gen_kwargs, чтобы datasets не взял из кеша
+    # датасет, собранный из прошлой версии файла по тому же пути
+    with open(json_path, 'r', encoding='utf8') as f:
+        for text in json.load(f).values():
+            yield {"text": text}
+
+
+def load_texts(dataset_path):
+    """
+    Загружает датасет с текстами примеров. Шарды jsonl и старый dataset.json
+    конвертируются в arrow на диске, и дальше datasets отображает их в память.
+
+    Args:
+        dataset_path (pathlib.Path) : Директория с шардами jsonl, файл jsonl или dataset.json
+
+    Returns:
+        datasets.Dataset : Датасет со столбцом text
+    """
+
+    dataset_path = Path(dataset_path)
+    if dataset_path.is_dir():
+        return Dataset.from_json(sorted(str(path) for path in dataset_path.glob('*.jsonl')))
+    if dataset_path.suffix == '.jsonl':
+        return Dataset.from_json(str(dataset_path))
+    return Dataset.from_generator(
+        _iter_json_texts, gen_kwargs={"json_path": str(dataset_path), "file_hash": _file_hash(dataset_path)}
+    )
 
 
-def tokenize_json(dataset_json, tokenizer):
+def tokenizer_hash(tokenizer):
+    """
+    Returns:
+        str : Хеш словаря и настроек токенайзера
+    """
+
+    try:
+        content = tokenizer.backend_tokenizer.to_str()
+    except AttributeError:
+        content = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    content += json.dumps(tokenizer.special_tokens_map, sort_keys=True)
+    return hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
+def _tokenize_with_labels(examples, tokenizer, max_length):
+    """
+    Токенизирует примеры без паддинга, добавляя в конец EOS.
+    Токены инструкции в labels заменяются на -100: модель учится только на ответах.
+    """
+
+    texts = [text + tokenizer.eos_token for text in examples["text"]]
+    encoded = tokenizer(texts, truncation=True, max_length=max_length, return_offsets_mapping=True)
+    labels = []
+    for text, input_ids, offsets in zip(texts, encoded["input_ids"], encoded["offset_mapping"]):
+        response_start = text.find(RESPONSE_MARKER)
+        response_start = response_start + len(RESPONSE_MARKER) if response_start != -1 else 0
+        labels.append([
+            token if start >= response_start and end > 0 else IGNORE_INDEX
+            for token, (start, end) in zip(input_ids, offsets)
+        ])
+    return {
+        "input_ids": encoded["input_ids"],
+        "attention_mask": encoded["attention_mask"],
+        "labels": labels,
+        "length": [len(input_ids) for input_ids in encoded["input_ids"]]
+    }
+
+
+def _pack(examples, max_length):
+    """Склеивает токенизированные примеры и нарезает их на блоки по max_length токенов"""
+    input_ids = list(itertools.chain.from_iterable(examples["input_ids"]))
+    labels = list(itertools.chain.from_iterable(examples["labels"]))
+    blocks = range(0, len(input_ids), max_length)
+    return {
+        "input_ids": [input_ids[i:i + max_length] for i in blocks],
+        "attention_mask": [[1] * len(input_ids[i:i + max_length]) for i in blocks],
+        "labels": [labels[i:i + max_length] for i in blocks],
+        "length": [len(input_ids[i:i + max_length]) for i in blocks]
+    }
+
+
+def tokenize_dataset(dataset, tokenizer, mode="dynamic", max_length=512, cache_dir=None):
+    """
+    Токенизирует датасет с текстами примеров
+
+    Args:
+        dataset (datasets.Dataset) : Датасет со столбцом text
+        tokenizer (transformers.AutoTokenizer) : Токенайзер
+        mode (str) : max_length и dynamic - по примеру на строку (паддинг делает PaddingCollator),
+            packing - примеры склеиваются в блоки по max_length токенов.
+            По умолчанию : dynamic
+        max_length (int) : Максимальная длина примера в токенах.
+            По умолчанию : 512
+        cache_dir (pathlib.Path | None) : Директория для кеша токенизированного датасета.
+            Ключ кеша - хеш токенайзера, отпечаток датасета и параметры токенизации,
+            поэтому при повторном запуске токенизация пропускается
+
+    Returns:
+        datasets.Dataset : Токенизированный датасет со столбцами input_ids, attention_mask,
+            labels (токены инструкции замаскированы -100) и length
+    """
+
+    if mode not in TOKENIZATION_MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {TOKENIZATION_MODES}")
+
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha256(
+            f"{tokenizer_hash(tokenizer)}:{dataset._fingerprint}:{mode}:{max_length}:{SEED}".encode('utf8')
+        ).hexdigest()[:16]
+        cache_path = Path(cache_dir) / f"tokenized-{key}"
+        if cache_path.exists():
+            return Dataset.load_from_disk(str(cache_path))
+
+    tokenized_dataset = dataset.map(
+        _tokenize_with_labels, batched=True, remove_columns=dataset.column_names,
+        fn_kwargs={"tokenizer": tokenizer, "max_length": max_length}
+    )
+    tokenized_dataset = tokenized_dataset.shuffle(seed=SEED)
+    if mode == "packing":
+        # Склеиваем после перемешивания, чтобы в блоке оказывались разные промпты
+        tokenized_dataset = tokenized_dataset.map(
+            _pack, batched=True, batch_size=1000, fn_kwargs={"max_length": max_length}
+        )
+
+    if cache_path is not None:
+        tokenized_dataset.save_to_disk(str(cache_path))
+        tokenized_dataset = Dataset.load_from_disk(str(cache_path))
+    return tokenized_dataset
+
+
+def tokenize_json(dataset_json, tokenizer, mode="dynamic", max_length=512):
     """
     Токенизирует json датасет
 
     Args:
         dataset_json (dict) : Датасет
         tokenizer (transformers.AutoTokenizer) : Токенайзер
+        mode (str) : Режим токенизации, см. tokenize_dataset
+        max_length (int) : Максимальная длина примера в токенах
 
     Returns:
         datasets.Dataset : Токенизированный датасет
     """
 
-    def tokenize_function(examples):
-        return tokenizer(
-            examples["text"],
-            truncation=True,
-            padding="max_length",
-            max_length=512,
-            return_special_tokens_mask=True
-        )
+    dataset = Dataset.from_dict({'text': list(dataset_json.values())})
+    return tokenize_dataset(dataset, tokenizer, mode, max_length)
 
-    data = {'text': []}
-    for key, value in dataset_json.items():
-        data['text'].append(value)
-    dataset = Dataset.from_dict(data)
-    tokenized_dataset = dataset.map(tokenize_function, batched=True, remove_columns=["text"])
-    tokenized_dataset = tokenized_dataset.shuffle(seed=SEED)
-    tokenized_dataset = tokenized_dataset.map(lambda x: {"labels": x["input_ids"]})
-    return tokenized_dataset
+
+class PaddingCollator:
+    """
+    Собирает батч, дополняя примеры паддингом справа до самого длинного в батче
+    (или до pad_to, если он задан). Паддинг в labels заменяется на -100.
+
+    Args:
+        tokenizer (transformers.AutoTokenizer) : Токенайзер
+        pad_to (int | None) : Фиксированная длина батча, как при padding="max_length"
+        pad_to_multiple_of (int) : Кратность длины батча
+    """
+
+    def __init__(self, tokenizer, pad_to=None, pad_to_multiple_of=8):
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.pad_to = pad_to
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features):
+        length = self.pad_to or max(len(feature["input_ids"]) for feature in features)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch = {"input_ids": [], "attention_mask": [], "labels": []}
+        for feature in features:
+            padding = length - len(feature["input_ids"])
+            batch["input_ids"].append(feature["input_ids"] + [self.pad_token_id] * padding)
+            batch["attention_mask"].append(feature["attention_mask"] + [0] * padding)
+            batch["labels"].append(feature["labels"] + [IGNORE_INDEX] * padding)
+        return {key: torch.tensor(value, dtype=torch.long) for key, value in batch.items()}
 
 
 if __name__ == '__main__':
@@ -131,6 +378,33 @@ if __name__ == '__main__':
         default=False,
         help='Flag for parsing'
     )
+    parser.add_argument('--pages', type=int, default=180, help='Количество страниц для парсинга')
+    parser.add_argument(
+        '--concurrency', type=int, default=4,
+        help='Максимальное количество одновременных запросов к сайту'
+    )
+    parser.add_argument(
+        '--interval', type=float, default=0.5,
+        help='Минимальный интервал между запросами к сайту, с'
+    )
+    parser.add_argument(
+        '--fresh', action='store_true',
+        help='Начать парсинг заново, а не продолжить с последней скачанной страницы'
+    )
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='Удалить точные и почти точные дубликаты поздравлений перед сборкой датасета'
+    )
+    parser.add_argument(
+        '--dedup_threshold', type=float, default=0.8,
+        help='Порог похожести по Жаккару, начиная с которого поздравления считаются дубликатами'
+    )
+    parser.add_argument('--workers', type=int, default=None, help='Количество процессов для дедупликации')
+    parser.add_argument(
+        '--format', type=str, default='jsonl', choices=['jsonl', 'json'],
+        help='Формат датасета: шарды jsonl в data/clean/dataset или один data/clean/dataset.json'
+    )
+    parser.add_argument('--shard_size', type=int, default=10000, help='Количество примеров в шарде jsonl')
     args = parser.parse_args()
 
     random.seed(SEED)
@@ -138,8 +412,16 @@ if __name__ == '__main__':
     wishes_path = project_dir / 'data/raw/wishes.txt'
     prompts_path = project_dir / 'data/raw/prompts.txt'
     json_path = project_dir / 'data/clean/dataset.json'
+    shards_dir = project_dir / 'data/clean/dataset'
     base_url = 'https://pozdravok.com'
     url = 'https://pozdravok.com/pozdravleniya/den-rozhdeniya/proza.htm'
     if args.parse:
-        parse_wishes(wishes_path, url, base_url)
-    raw2json(wishes_path, prompts_path, json_path)
+        parse_wishes(wishes_path, url, base_url, args.pages, args.concurrency, args.interval, args.fresh)
+    if args.dedup:
+        dedup_path = project_dir / 'data/raw/wishes.dedup.txt'
+        dedup_wishes(wishes_path, dedup_path, args.dedup_threshold, workers=args.workers)
+        wishes_path = dedup_path
+    if args.format == 'jsonl':
+        raw2jsonl(wishes_path, prompts_path, shards_dir, args.shard_size)
+    else:
+        raw2json(wishes_path, prompts_path, json_path)
@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import aiohttp
+import tqdm
+from bs4 import BeautifulSoup
+from urllib.parse import urljoin, urlsplit
+
+
+USER_AGENT = "Mozilla/5.0 (compatible; birthday-bot-dataset/1.0)"
+
+
+class HostRateLimiter:
+    """
+    Ограничивает частоту запросов к каждому хосту: не чаще, чем раз в interval секунд
+    (со случайной добавкой до jitter секунд, чтобы не нагружать сайт ровными очередями)
+
+    Args:
+        interval (float) : Минимальный интервал между запросами к одному хосту, с
+        jitter (float) : Максимальная случайная добавка к интервалу, с
+    """
+
+    def __init__(self, interval=0.5, jitter=0.5):
+        self.interval = interval
+        self.jitter = jitter
+        self._next = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, url):
+        host = urlsplit(url).netloc
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval + random.uniform(0, self.jitter)
+        await asyncio.sleep(start - now)
+
+
+def wish_hash(wish):
+    """Хеш поздравления без учета регистра и пробелов"""
+    return hashlib.sha1(' '.join(wish.lower().split()).encode('utf8')).hexdigest()
+
+
+class WishWriter:
+    """
+    Дописывает поздравления в txt файл (через пустую строку), пропуская уже записанные.
+    При возобновлении хеши восстанавливаются из уже записанного файла.
+
+    Args:
+        wishes_path (pathlib.Path) : Путь к txt файлу с поздравлениями
+    """
+
+    def __init__(self, wishes_path):
+        self.hashes = set()
+        self.duplicates = 0
+        if os.path.exists(wishes_path):
+            with open(wishes_path, 'r', encoding='utf8') as f:
+                for wish in f.read().split('\n\n'):
+                    if wish.strip():
+                        self.hashes.add(wish_hash(wish))
+        self._file = open(wishes_path, 'a', encoding='utf8')
+
+    def write(self, wishes):
+        """
+        Returns:
+            int : Количество новых поздравлений
+        """
+
+        added = 0
+        for wish in wishes:
+            key = wish_hash(wish)
+            if not wish.strip() or key in self.hashes:
+                self.duplicates += bool(wish.strip())
+                continue
+            self.hashes.add(key)
+            self._file.write(wish + '\n\n')
+            added += 1
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return added
+
+    def close(self):
+        self._file.close()
+
+
+def extract_page(html, base_url):
+    """
+    Returns:
+        (list, str | None) : Поздравления со страницы и URL следующей страницы
+    """
+
+    soup = BeautifulSoup(html, 'html.parser')
+    content = soup.find('div', {'class': 'content'})
+    wishes = [wish.get_text().replace('\xa0', ' ').strip() for wish in content.find_all('p')] if content else []
+    next_block = soup.find('div', {'class': 'pages_next'})
+    link = next_block.find('a', href=True) if next_block else None
+    return wishes, urljoin(base_url, link['href']) if link else None
+
+
+def page_url(url, page):
+    """URL страницы с номером page: первая страница - url, остальные - url с суффиксом -<page>"""
+    if page == 1:
+        return url
+    stem, dot, extension = url.rpartition('.')
+    return f'{stem}-{page}.{extension}' if dot else f'{url}-{page}'
+
+
+def load_checkpoint(checkpoint_path, url):
+    try:
+        with open(checkpoint_path, 'r', encoding='utf8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {"url": url, "done": [], "mode": None, "next_url": url}
+    if state.get("url") != url:
+        raise ValueError(f"Checkpoint {checkpoint_path} was made for {state.get('url')}, use --fresh to restart")
+    return state
+
+
+def save_checkpoint(checkpoint_path, state):
+    tmp_path = f'{checkpoint_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+async def fetch(session, limiter, url, attempts=4):
+    """
+    Returns:
+        str | None : HTML страницы или None, если страницы нет
+    """
+
+    for attempt in range(attempts):
+        await limiter.wait(url)
+        try:
+            async with session.get(url) as response:
+                if response.status == 404:
+                    return None
+                response.raise_for_status()
+                return await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+async def scrape_wishes(wishes_path, url, base_url, pages=180, concurrency=4, interval=0.5,
+                        checkpoint_path=None, fresh=False):
+    """
+    Асинхронно парсит поздравления с сайта Поздравок, возобновляясь с места остановки.
+
+    Страницы скачиваются через одну сессию с пулом соединений, не больше concurrency одновременно
+    и не чаще, чем раз в interval секунд к одному хосту. Если ссылка "дальше" на первой странице
+    ведет на page_url(url, 2), остальные страницы скачиваются параллельно по номерам, иначе -
+    последовательно по ссылкам "дальше". После каждой страницы новые поздравления дописываются
+    в файл, а номер страницы - в чекпоинт.
+
+    Args:
+        wishes_path (pathlib.Path) : Путь к txt файлу для сохранения поздравлений
+        url (str) : URL первой страницы
+        base_url (str) : URL главной страницы сайта
+        pages (int) : Количество страниц
+        concurrency (int) : Максимальное количество одновременных запросов
+        interval (float) : Минимальный интервал между запросами к одному хосту, с
+        checkpoint_path (pathlib.Path | None) : Путь к чекпоинту. По умолчанию рядом с wishes_path
+        fresh (bool) : Начать заново, удалив уже скачанные поздравления и чекпоинт
+
+    Returns:
+        dict : Статистика: страницы, новые поздравления и дубликаты
+    """
+
+    checkpoint_path = checkpoint_path or f'{wishes_path}.checkpoint.json'
+    if fresh:
+        for path in (wishes_path, checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    state = load_checkpoint(checkpoint_path, url)
+    done = set(state["done"])
+    writer = WishWriter(wishes_path)
+    limiter = HostRateLimiter(interval)
+    stats = {"pages": 0, "wishes": 0, "duplicates": 0}
+    progress = tqdm.tqdm(total=pages, initial=len(done), desc='Parsing')
+
+    def page_done(page, wishes, next_url=None):
+        stats["pages"] += 1
+        stats["wishes"] += writer.write(wishes)
+        done.add(page)
+        state["done"] = sorted(done)
+        state["next_url"] = next_url
+        save_checkpoint(checkpoint_path, state)
+        progress.update()
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers={"User-Agent": USER_AGENT}
+        ) as session:
+            if state["mode"] is None:
+                html = await fetch(session, limiter, url)
+                wishes, next_url = extract_page(html or '', base_url)
+                state["mode"] = "numbered" if next_url == page_url(url, 2) else "next"
+                page_done(1, wishes, next_url)
+
+            if state["mode"] == "numbered":
+                queue = asyncio.Queue()
+                for page in range(1, pages + 1):
+                    if page not in done:
+                        queue.put_nowait(page)
+
+                async def worker():
+                    while not queue.empty():
+                        page = queue.get_nowait()
+                        html = await fetch(session, limiter, page_url(url, page))
+                        page_done(page, extract_page(html, base_url)[0] if html else [])
+
+                # Если один воркер упал, остальные отменяются до того, как закроются сессия,
+                # файл и чекпоинт (asyncio.TaskGroup появился только в Python 3.11)
+                workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+            else:
+                next_url = state["next_url"]
+                while next_url and len(done) < pages:
+                    html = await fetch(session, limiter, next_url)
+                    wishes, following = extract_page(html or '', base_url)
+                    page_done(len(done) + 1, wishes, following)
+                    next_url = following
+    finally:
+        progress.close()
+        writer.close()
+    stats["duplicates"] = writer.duplicates
+    return stats
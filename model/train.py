@@ -1,33 +1,52 @@
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from transformers import TrainingArguments, Trainer
+from transformers import TrainingArguments, Trainer, TrainerCallback
 from peft import LoraConfig, get_peft_model
 from pathlib import Path
 import argparse
-import torch
+import gc
+import heapq
 import json
-from preprocess import tokenize_json
+import threading
+import time
+import psutil
+import torch
+from preprocess import load_texts, tokenize_dataset, PaddingCollator, TOKENIZATION_MODES
+from inference import cpu_supports_bf16
+
+
+LORA_TARGETS = ("q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj")
+DTYPES = ("auto", "bf16", "fp32")
 
 
-def prepare_model_and_tokenizer(model_id):
+def prepare_model_and_tokenizer(model_id, cpu=False, dtype="bf16", lora_targets=("q_proj", "v_proj"),
+                                gradient_checkpointing=False):
     """
     Возвращает модель и токенизатор к ней
 
     Args:
         model_id (str) : ID модели
-    
+        cpu (bool) : Загрузить модель на CPU, иначе модель распределяется по доступным устройствам
+        dtype (str) : bf16 или fp32
+        lora_targets (Iterable[str]) : Модули, к которым добавляются LoRA адаптеры
+        gradient_checkpointing (bool) : Пересчитывать активации при обратном проходе
+            вместо хранения, что экономит память ценой примерно трети времени шага
+
     Returns:
         (AutoModelForCausalLM, AutoTokenizer) : Модель и токенайзер
     """
 
     base_model = AutoModelForCausalLM.from_pretrained(
         model_id,
-        torch_dtype=torch.bfloat16,
-        device_map="auto"
+        torch_dtype=torch.bfloat16 if dtype == "bf16" else torch.float32,
+        device_map="cpu" if cpu else "auto"
     )
+    if gradient_checkpointing:
+        base_model.config.use_cache = False
+        base_model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
     lora_config = LoraConfig(
         r=16,
         lora_alpha=32,
-        target_modules=["q_proj", "v_proj"],
+        target_modules=list(lora_targets),
         lora_dropout=0.05,
         bias="none",
         task_type="CAUSAL_LM"
@@ -37,6 +56,135 @@ def prepare_model_and_tokenizer(model_id):
     return model, tokenizer
 
 
+class MemorySampler:
+    """
+    Фоновый поток, который каждые interval секунд замеряет RSS процесса
+    и запоминает пиковое значение между вызовами reset
+
+    Args:
+        interval (float) : Период замеров, с
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._process = psutil.Process()
+        self._peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, self.rss())
+
+    def rss(self):
+        return self._process.memory_info().rss
+
+    def reset(self):
+        """
+        Returns:
+            int : Пиковый RSS в байтах с прошлого вызова
+        """
+
+        peak, self._peak = max(self._peak, self.rss()), 0
+        return peak
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def find_batch_size(model, dataset, collator, memory_budget, sampler, max_batch_size=64):
+    """
+    Подбирает наибольший размер батча (степень двойки), при котором прямой и обратный проход
+    на самых длинных примерах датасета не выходит за memory_budget байт пикового RSS
+
+    Args:
+        model (PeftModel) : Модель
+        dataset (datasets.Dataset) : Токенизированный датасет со столбцом length
+        collator (PaddingCollator) : Коллатор
+        memory_budget (int) : Бюджет памяти процесса в байтах
+        sampler (MemorySampler) : Замер пиковой памяти
+        max_batch_size (int) : Максимальный размер батча
+
+    Returns:
+        int : Размер батча
+    """
+
+    lengths = dataset["length"]
+    longest = heapq.nlargest(max_batch_size, range(len(lengths)), key=lengths.__getitem__)
+    batch_size, fits = 1, 0
+    model.train()
+    while batch_size <= min(max_batch_size, len(longest)):
+        batch = collator([dataset[index] for index in longest[:batch_size]])
+        batch = {key: value.to(model.device) for key, value in batch.items()}
+        sampler.reset()
+        try:
+            model(**batch).loss.backward()
+            peak = sampler.reset()
+        except RuntimeError:
+            # На CPU нехватка памяти - RuntimeError из аллокатора
+            peak = float("inf")
+        model.zero_grad(set_to_none=True)
+        del batch
+        gc.collect()
+        print(f"batch_size={batch_size}: пиковый RSS {peak / 2 ** 30:.2f} ГБ из {memory_budget / 2 ** 30:.2f} ГБ")
+        if peak > memory_budget:
+            break
+        fits = batch_size
+        batch_size *= 2
+    if not fits:
+        print("Даже batch_size=1 не помещается в бюджет памяти, обучение может упасть")
+    return max(fits, 1)
+
+
+class ThroughputCallback(TrainerCallback):
+    """
+    После каждого шага оптимизатора пишет в log_path строку json со временем шага,
+    скоростью в токенах в секунду (с паддингом), текущим и пиковым за шаг RSS.
+    Каждые logging_steps шагов та же строка выводится в консоль.
+
+    Args:
+        log_path (pathlib.Path) : Путь к jsonl файлу
+        sampler (MemorySampler) : Замер пиковой памяти
+    """
+
+    def __init__(self, log_path, sampler):
+        self.log_path = log_path
+        self.sampler = sampler
+        self._file = None
+        self._start = None
+        self._tokens = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._file = open(self.log_path, 'a', encoding='utf8')
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.sampler.reset()
+        self._start = time.perf_counter()
+        self._tokens = state.num_input_tokens_seen
+
+    def on_step_end(self, args, state, control, **kwargs):
+        elapsed = time.perf_counter() - self._start
+        tokens = state.num_input_tokens_seen - self._tokens
+        record = {
+            "step": state.global_step,
+            "step_s": round(elapsed, 3),
+            "tokens_per_sec": round(tokens / elapsed, 1),
+            "rss_gb": round(self.sampler.rss() / 2 ** 30, 2),
+            "peak_rss_gb": round(self.sampler.reset() / 2 ** 30, 2)
+        }
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if state.global_step % args.logging_steps == 0:
+            print(json.dumps(record))
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 if __name__ == '__main__':
     project_dir = Path(__file__).parent.parent
     parser = argparse.ArgumentParser(
@@ -50,43 +198,136 @@ if __name__ == '__main__':
         '--epochs', type=int, default=6,
         help='Количество эпох'
     )
+    shards_dir = project_dir / 'data/clean/dataset'
+    parser.add_argument(
+        '--dataset_path', type=str,
+        default=shards_dir if shards_dir.exists() else project_dir / 'data/clean/dataset.json',
+        help='Путь к датасету: директория с шардами jsonl, файл jsonl или dataset.json'
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=project_dir / 'data/cache',
+        help='Директория для кеша токенизированного датасета'
+    )
+    parser.add_argument(
+        '--mode', type=str, default="dynamic", choices=TOKENIZATION_MODES,
+        help='max_length - паддинг до max_length, dynamic - паддинг до самого длинного примера в батче '
+             'с группировкой примеров по длине, packing - склейка примеров в блоки по max_length'
+    )
+    parser.add_argument(
+        '--max_length', type=int, default=512,
+        help='Максимальная длина примера в токенах'
+    )
+    parser.add_argument(
+        '--cpu', action='store_true',
+        help='Профиль обучения на CPU: модель на CPU, dtype по возможностям процессора, '
+             'gradient checkpointing и подбор размера батча под бюджет памяти'
+    )
     parser.add_argument(
-        '--dataset_path', type=str, default=project_dir / 'data/clean/dataset.json',
-        help='Путь к датасету'
+        '--dtype', type=str, default="auto", choices=DTYPES,
+        help='Тип весов и вычислений. auto - bf16 на GPU, а на CPU bf16 только при его аппаратной поддержке'
+    )
+    parser.add_argument(
+        '--gradient_checkpointing', action=argparse.BooleanOptionalAction, default=None,
+        help='Пересчитывать активации при обратном проходе. По умолчанию включено с --cpu'
+    )
+    parser.add_argument('--threads', type=int, default=None, help='Количество потоков torch')
+    parser.add_argument(
+        '--interop_threads', type=int, default=None,
+        help='Количество потоков torch для параллельного выполнения независимых операций'
+    )
+    parser.add_argument(
+        '--lora_targets', type=str, nargs='+', default=["q_proj", "v_proj"], choices=LORA_TARGETS,
+        help='Модули, к которым добавляются LoRA адаптеры'
+    )
+    parser.add_argument('--batch_size', type=int, default=2, help='Размер батча')
+    parser.add_argument('--grad_accum', type=int, default=4, help='Количество шагов накопления градиента')
+    parser.add_argument(
+        '--auto_batch_size', action=argparse.BooleanOptionalAction, default=None,
+        help='Подобрать размер батча под --memory_budget, сохранив batch_size * grad_accum. '
+             'По умолчанию включено с --cpu'
+    )
+    parser.add_argument(
+        '--memory_budget', type=float, default=None,
+        help='Бюджет памяти процесса для подбора размера батча, ГБ. По умолчанию 90%% доступной памяти'
     )
     args = parser.parse_args()
 
+    # Потоки задаются до загрузки модели: число inter-op потоков нельзя менять после первых вычислений
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads:
+        torch.set_num_interop_threads(args.interop_threads)
+    dtype = args.dtype
+    if dtype == "auto":
+        dtype = "bf16" if not args.cpu or cpu_supports_bf16() else "fp32"
+    gradient_checkpointing = args.cpu if args.gradient_checkpointing is None else args.gradient_checkpointing
+    auto_batch_size = args.cpu if args.auto_batch_size is None else args.auto_batch_size
+    sampler = MemorySampler()
+
     model_id = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
-    model, tokenizer = prepare_model_and_tokenizer(model_id)
+    model, tokenizer = prepare_model_and_tokenizer(
+        model_id, args.cpu, dtype, args.lora_targets, gradient_checkpointing
+    )
     model.train()
 
-    with open(args.dataset_path, 'r') as f:
-        dataset_json = json.load(f)
-    tokenized_dataset = tokenize_json(dataset_json, tokenizer)
+    tokenized_dataset = tokenize_dataset(
+        load_texts(args.dataset_path), tokenizer, args.mode, args.max_length, args.cache_dir
+    )
+    collator = PaddingCollator(tokenizer, pad_to=args.max_length if args.mode == "max_length" else None)
+
+    batch_size, grad_accum = args.batch_size, args.grad_accum
+    if auto_batch_size:
+        if args.memory_budget:
+            memory_budget = int(args.memory_budget * 2 ** 30)
+        else:
+            memory_budget = int(0.9 * (sampler.rss() + psutil.virtual_memory().available))
+        batch_size = find_batch_size(
+            model, tokenized_dataset, collator, memory_budget, sampler,
+            max_batch_size=args.batch_size * args.grad_accum
+        )
+        grad_accum = max(1, args.batch_size * args.grad_accum // batch_size)
+        print(f"batch_size={batch_size}, grad_accum={grad_accum}")
 
+    output_dir = Path("./tinyllama-lora-finetuned")
+    output_dir.mkdir(parents=True, exist_ok=True)
     training_args = TrainingArguments(
-        output_dir="./tinyllama-lora-finetuned",
+        output_dir=str(output_dir),
         overwrite_output_dir=True,
-        per_device_train_batch_size=2,
-        gradient_accumulation_steps=4,
+        per_device_train_batch_size=batch_size,
+        gradient_accumulation_steps=grad_accum,
         learning_rate=args.lr,
         lr_scheduler_type='cosine',
         num_train_epochs=args.epochs,
         logging_steps=10,
         save_steps=200,
         save_total_limit=2,
-        bf16=True,
+        bf16=dtype == "bf16",
+        use_cpu=args.cpu,
+        dataloader_pin_memory=not args.cpu,
+        include_num_input_tokens_seen=True,
         label_names=["labels"],
+        group_by_length=args.mode == "dynamic",
+        length_column_name="length",
         report_to="none"
     )
 
     trainer = Trainer(
         model=model,
         args=training_args,
-        train_dataset=tokenized_dataset
+        train_dataset=tokenized_dataset,
+        data_collator=collator,
+        callbacks=[ThroughputCallback(output_dir / "throughput.jsonl", sampler)]
     )
 
-    trainer.train()
+    result = trainer.train()
+    # Считаются только настоящие токены, без паддинга, чтобы режимы можно было сравнивать
+    runtime = result.metrics["train_runtime"]
+    tokens = sum(tokenized_dataset["length"]) * args.epochs
+    print(
+        f"Режим {args.mode}: {tokens / runtime:.1f} токенов/с, "
+        f"эпоха {runtime / args.epochs:.1f} с, всего {runtime:.1f} с"
+    )
     trainer.save_model(project_dir / "tinyllama/lora-final")
     merged_model = model.merge_and_unload()
     merged_model.save_pretrained(project_dir / "tinyllama/merged")
+    sampler.close()
@@ -0,0 +1,17 @@
+import asyncio
+import sys
+from pathlib import Path
+import pytest
+
+# Тесты импортируют пакеты bot и model так же, как main.py, из корня репозитория
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "model"))
+
+
+@pytest.fixture
+def run():
+    """Выполняет корутину в отдельном event loop"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
@@ -0,0 +1,42 @@
+import main
+from bot.handlers import generate
+from bot.services.generation import generation_service
+
+
+def test_reminders_are_sent_when_generation_fails(run, monkeypatch):
+    calls = []
+
+    def generate_batch(n, names=None):
+        calls.append(names)
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")
+        return [f"Поздравление для {name}" for name in names]
+
+    async def model_loaded():
+        return True
+
+    sent = []
+
+    async def enqueue(messages):
+        sent.extend(messages)
+
+    monkeypatch.setattr(generate, "generate_batch", generate_batch)
+    monkeypatch.setattr(generate, "wait_model", model_loaded)
+    monkeypatch.setattr(generate, "batch_size", 2)
+    monkeypatch.setattr(generate.wish_pool, "take_many", lambda n: [])
+    monkeypatch.setattr(main.sender, "enqueue", enqueue)
+
+    async def scenario():
+        await generation_service.start()
+        try:
+            await main.birthday_wish([(1, "Анна"), (2, "Борис"), (3, "Вера")])
+        finally:
+            await generation_service.stop()
+
+    run(scenario())
+
+    assert calls == [["Анна", "Борис"], ["Вера"]]
+    assert [chat_id for chat_id, _ in sent] == [1, 2, 3]
+    # Первый батч упал: напоминания без текста поздравления
+    assert all("Текст поздравления" not in text for _, text in sent[:2])
+    assert "Поздравление для Вера" in sent[2][1]
@@ -0,0 +1,53 @@
+import io
+from datetime import date
+from html.parser import HTMLParser
+from bot.handlers.dates import format_dates, format_upcoming
+from bot.utils.contacts import parse_birthdays
+
+
+VCARD = (
+    "BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Tom & Jerry <TJ>\r\nBDAY:--0305\r\nEND:VCARD\r\n"
+    "BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Анна\r\nBDAY:--0307\r\nEND:VCARD\r\n"
+)
+
+
+class TextCollector(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tags = []
+        self.text = ''
+
+    def handle_starttag(self, tag, attrs):
+        self.tags.append(tag)
+
+    def handle_data(self, data):
+        self.text += data
+
+
+def render(markup):
+    parser = TextCollector()
+    parser.feed(markup)
+    return parser
+
+
+def imported_rows():
+    parsed = parse_birthdays(io.BytesIO(VCARD.encode('utf8')), 'vcf')
+    return [(i, birthday, name) for i, (birthday, name) in enumerate(parsed, start=1)]
+
+
+def test_imported_names_are_escaped_in_list():
+    rows = imported_rows()
+    assert rows[0][2] == "Tom & Jerry <TJ>"
+
+    markup = format_dates(rows)
+    parsed = render(markup)
+    assert "<TJ>" not in markup
+    assert parsed.tags == ['b', 'b']
+    assert parsed.text == "1. Tom & Jerry <TJ>, 05.03\n2. Анна, 07.03\n"
+
+
+def test_imported_names_are_escaped_in_upcoming():
+    markup = format_upcoming(imported_rows(), date(2026, 3, 5))
+    parsed = render(markup)
+    assert parsed.tags == ['b', 'b']
+    assert parsed.text == "Tom & Jerry <TJ>, 05.03 - сегодня\nАнна, 07.03 - через 2 дн.\n"
@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import json
+import pytest
+from aiohttp import web
+import scraper
+from scraper import scrape_wishes
+
+
+class Site:
+    """Локальный сайт со страницами поздравлений в разметке Поздравка"""
+
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.pages = {}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.root = None
+
+    def add_page(self, path, wishes, next_path=None):
+        paragraphs = ''.join(f'<p>{wish}</p>' for wish in wishes)
+        pages_next = f'<div class="pages_next"><a href="{next_path}">дальше</a></div>' if next_path else ''
+        self.pages[path] = f'<html><body><div class="content">{paragraphs}</div>{pages_next}</body></html>'
+
+    def add_numbered(self, count, per_page=2):
+        for page in range(1, count + 1):
+            self.add_page(
+                numbered_path(page),
+                [f'Поздравление {page}-{i}' for i in range(per_page)],
+                numbered_path(page + 1) if page < count else None
+            )
+
+    async def handle(self, request):
+        self.requests.append(request.path_qs)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if request.path_qs not in self.pages:
+                raise web.HTTPNotFound()
+            return web.Response(text=self.pages[request.path_qs], content_type='text/html')
+        finally:
+            self.active -= 1
+
+
+def numbered_path(page):
+    return '/proza.htm' if page == 1 else f'/proza-{page}.htm'
+
+
+def read_wishes(path):
+    with open(path, 'r', encoding='utf8') as f:
+        return [wish for wish in f.read().split('\n\n') if wish.strip()]
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(scraper, "HostRateLimiter", functools.partial(scraper.HostRateLimiter, jitter=0))
+
+
+@pytest.fixture
+def site(run):
+    site = Site()
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', site.handle)
+    runner = web.AppRunner(app)
+    run(runner.setup())
+    run(web.TCPSite(runner, '127.0.0.1', 0).start())
+    site.root = 'http://127.0.0.1:%d' % runner.addresses[0][1]
+    yield site
+    run(runner.cleanup())
+
+
+def test_numbered_pages_are_fetched_concurrently(site, run, tmp_path):
+    site.add_numbered(8)
+    wishes_path = tmp_path / 'wishes.txt'
+
+    stats = run(scrape_wishes(wishes_path, site.root + numbered_path(1), site.root, pages=8, concurrency=4, interval=0))
+
+    assert stats == {"pages": 8, "wishes": 16, "duplicates": 0}
+    assert 1 < site.max_active <= 4
+    assert sorted(read_wishes(wishes_path)) == sorted(f'Поздравление {p}-{i}' for p in range(1, 9) for i in range(2))
+    with open(f'{wishes_path}.checkpoint.json', 'r', encoding='utf8') as f:
+        assert json.load(f)["mode"] == "numbered"
+
+
+def test_resume_after_crash(site, run, tmp_path, monkeypatch):
+    site.add_numbered(6)
+    wishes_path = tmp_path / 'wishes.txt'
+    url = site.root + numbered_path(1)
+    fetch = scraper.fetch
+
+    async def crashing_fetch(session, limiter, page_url, attempts=4):
+        if page_url.endswith(numbered_path(4)):
+            raise RuntimeError("crash")
+        return await fetch(session, limiter, page_url, attempts)
+
+    monkeypatch.setattr(scraper, "fetch", crashing_fetch)
+    with pytest.raises(RuntimeError):
+        run(scrape_wishes(wishes_path, url, site.root, pages=6, concurrency=1, interval=0))
+    with open(f'{wishes_path}.checkpoint.json', 'r', encoding='utf8') as f:
+        assert json.load(f)["done"] == [1, 2, 3]
+
+    monkeypatch.setattr(scraper, "fetch", fetch)
+    stats = run(scrape_wishes(wishes_path, url, site.root, pages=6, concurrency=2, interval=0))
+
+    assert stats["pages"] == 3
+    assert len(read_wishes(wishes_path)) == 12
+    # Уже скачанные страницы повторно не запрашиваются
+    for page in (1, 2, 3):
+        assert site.requests.count(numbered_path(page)) == 1
+
+
+def test_duplicates_are_skipped_by_hash(site, run, tmp_path):
+    site.add_page('/proza.htm', ['С днем рождения!', 'Будь счастлив'], '/proza-2.htm')
+    site.add_page('/proza-2.htm', ['с днем   РОЖДЕНИЯ!', 'Новое поздравление'])
+    wishes_path = tmp_path / 'wishes.txt'
+
+    stats = run(scrape_wishes(wishes_path, site.root + '/proza.htm', site.root, pages=2, interval=0))
+
+    assert stats == {"pages": 2, "wishes": 3, "duplicates": 1}
+    assert read_wishes(wishes_path) == ['С днем рождения!', 'Будь счастлив', 'Новое поздравление']
+
+
+def test_next_link_fallback(site, run, tmp_path):
+    site.add_page('/list', ['Первое'], '/list?page=2')
+    site.add_page('/list?page=2', ['Второе'], '/list?page=3')
+    site.add_page('/list?page=3', ['Третье'])
+    wishes_path = tmp_path / 'wishes.txt'
+
+    stats = run(scrape_wishes(wishes_path, site.root + '/list', site.root, pages=10, concurrency=4, interval=0))
+
+    assert stats["pages"] == 3
+    assert read_wishes(wishes_path) == ['Первое', 'Второе', 'Третье']
+    assert site.requests == ['/list', '/list?page=2', '/list?page=3']
+    with open(f'{wishes_path}.checkpoint.json', 'r', encoding='utf8') as f:
+        assert json.load(f)["mode"] == "next"
+
+
+def test_crash_cancels_other_workers(site, run, tmp_path, monkeypatch):
+    site.add_numbered(12)
+    site.delay = 0.05
+    wishes_path = tmp_path / 'wishes.txt'
+    fetch = scraper.fetch
+
+    async def crashing_fetch(session, limiter, page_url, attempts=4):
+        if page_url.endswith(numbered_path(5)):
+            raise RuntimeError("crash")
+        return await fetch(session, limiter, page_url, attempts)
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await scrape_wishes(
+                wishes_path, site.root + numbered_path(1), site.root, pages=12, concurrency=4, interval=0
+            )
+        # К моменту выхода из scrape_wishes не осталось воркеров, которые пишут в закрытый файл
+        return [
+            task for task in asyncio.all_tasks()
+            if not task.done() and task.get_coro().__qualname__.startswith('scrape_wishes.')
+        ]
+
+    monkeypatch.setattr(scraper, "fetch", crashing_fetch)
+    assert run(scenario()) == []
+    with open(f'{wishes_path}.checkpoint.json', 'r', encoding='utf8') as f:
+        done = json.load(f)["done"]
+    assert 5 not in done
+    assert sorted(read_wishes(wishes_path)) == sorted(f'Поздравление {p}-{i}' for p in done for i in range(2))
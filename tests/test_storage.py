@@ -0,0 +1,92 @@
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from bot import db
+from bot import storage as storage_module
+from bot.storage import SQLiteStorage
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(storage_module, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def database(tmp_path, run):
+    path = tmp_path / "fsm.db"
+    run(db.connect(path))
+    yield path
+    run(db.close())
+
+
+def key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_state_and_data_survive_restart(database, run, clock):
+    storage = SQLiteStorage()
+    run(storage.set_state(key(1), "AddForm:name_input"))
+    run(storage.set_data(key(1), {"birthday_date": "01.02"}))
+    run(db.close())
+
+    run(db.connect(database))
+    restarted = SQLiteStorage()
+    assert run(restarted.get_state(key(1))) == "AddForm:name_input"
+    assert run(restarted.get_data(key(1))) == {"birthday_date": "01.02"}
+
+
+def test_expired_state_is_reset(database, run, clock):
+    storage = SQLiteStorage(ttl=60)
+    run(storage.set_state(key(1), "AddForm:date_input"))
+    run(storage.set_data(key(1), {"birthday_date": "01.02"}))
+
+    clock.now += 61
+    assert run(storage.get_state(key(1))) is None
+    assert run(storage.get_data(key(1))) == {}
+    # Из базы устаревшее состояние тоже не читается
+    assert run(SQLiteStorage(ttl=60).get_state(key(1))) is None
+
+
+def test_cleanup_deletes_expired_rows(database, run, clock):
+    storage = SQLiteStorage(ttl=60)
+    run(storage.set_state(key(1), "AddForm:date_input"))
+    run(db.delete_expired_fsm(clock.now + 1))
+    assert run(db.get_fsm(SQLiteStorage._key(key(1)))) is None
+
+
+def test_lru_eviction(database, run, clock):
+    storage = SQLiteStorage(cache_size=2)
+    for user_id in (1, 2, 3):
+        run(storage.set_state(key(user_id), f"state_{user_id}"))
+
+    assert SQLiteStorage._key(key(1)) not in storage._cache
+    assert list(storage._cache) == [SQLiteStorage._key(key(2)), SQLiteStorage._key(key(3))]
+    # Вытесненное состояние читается из базы и снова попадает в кеш
+    assert run(storage.get_state(key(1))) == "state_1"
+    assert SQLiteStorage._key(key(2)) not in storage._cache
+
+
+def test_without_cache_reads_through_to_database(database, run, clock):
+    storage = SQLiteStorage(cache_size=0)
+    run(storage.set_state(key(1), "AddForm:date_input"))
+    assert not storage._cache
+
+    # Состояние изменил другой процесс бота
+    run(db.set_fsm(SQLiteStorage._key(key(1)), "AddForm:name_input", "{}", clock.now))
+    assert run(storage.get_state(key(1))) == "AddForm:name_input"
+
+
+def test_clearing_state_deletes_row(database, run, clock):
+    storage = SQLiteStorage()
+    run(storage.set_state(key(1), "AddForm:date_input"))
+    run(storage.set_state(key(1), None))
+    assert run(db.get_fsm(SQLiteStorage._key(key(1)))) is None